@@ -0,0 +1,72 @@
+#!/usr/bin/python2
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import Genomics
+import Support
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the throughput of focal CNAs applied to a chromosome for increasing numbers of bins')
+    parser.add_argument('-b', '--binsize', type=str, required=False, default='1kb', help='Size of bins (default: 1kb)')
+    parser.add_argument('-l', '--lengths', type=str, required=False, default='1Mb 10Mb 50Mb 250Mb', help='White-space separated list of chromosome lengths (default: "1Mb 10Mb 50Mb 250Mb")')
+    parser.add_argument('-e', '--events', type=int, required=False, default=1000, help='Number of focal CNAs applied for every length (default: 1000)')
+    parser.add_argument('-f', '--focal', type=str, required=False, default='100kb', help='Mean size of focal CNAs (default: 100kb)')
+    parser.add_argument('-s', '--rndseed', type=int, required=False, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+    return Support.basesize(args.binsize), [Support.basesize(l) for l in args.lengths.split()], args.events, Support.basesize(args.focal), args.rndseed
+
+
+def linear(chromosome, start, size):
+    # Lookup of the previous implementation scanning the cumulative lengths of all the bins
+    last = chromosome.numbins - 1
+    cumsum = list(Support.cumsum(chromosome.binsize if b != last else chromosome.lastsize for b in chromosome.maternalHaplotype))
+    startbin = next(i for i, c in enumerate(cumsum) if c > start)
+    endbin = next((i for i, c in enumerate(cumsum[startbin:]) if c > start + size), None)
+    return startbin, startbin + endbin + 1 if endbin != None else len(cumsum)
+
+
+def run(length, binsize, events, focal, seed):
+    random.seed(seed)
+    chromosome = Genomics.Chromosome(name='chr', length=length, binsize=binsize)
+    lookups = 0.0
+    scans = 0.0
+    begin = time.time()
+    for e in xrange(events):
+        size = min(max(int(round(random.gauss(focal, focal * 0.2))), 0), chromosome.maternalHaplotypeLength)
+        start = random.randint(0, max(chromosome.maternalHaplotypeLength - 1 - size, 0))
+        if e % 10 == 0:
+            t = time.time()
+            expected = linear(chromosome, start, size)
+            scans += time.time() - t
+            t = time.time()
+            offset = (lambda k : chromosome.offset(chromosome.maternalLastBins, k))
+            found = Support.startendbins(offset=offset, numbins=len(chromosome.maternalHaplotype), start=start, size=size)
+            lookups += time.time() - t
+            assert(found == expected)
+        # Duplications and deletions are balanced to keep the number of bins about constant
+        if random.random() < 0.5:
+            chromosome.tandemDuplicate(start=start, size=size, allele='m')
+        else:
+            chromosome.delete(start=start, size=size, allele='m')
+    elapsed = time.time() - begin - scans
+    checks = -(-events // 10)
+    return len(chromosome.maternalHaplotype), events / elapsed, checks / lookups if lookups > 0 else float('inf'), checks / scans if scans > 0 else float('inf')
+
+
+def main():
+    binsize, lengths, events, focal, seed = parse_args()
+    print '\t'.join(['#LENGTH', 'BINS', 'EVENTS/S', 'INDEXED_LOOKUPS/S', 'LINEAR_LOOKUPS/S'])
+    for length in lengths:
+        numbins, throughput, indexed, scan = run(length, binsize, events, focal, seed)
+        print '\t'.join(map(str, [length, numbins, int(throughput), int(indexed), int(scan)]))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -55,24 +55,14 @@ mkdir -p ${BULK}
 
 
 echo -e "\033[1m\033[95m## Simulating genomes \033[0m"
-\time -v ${MASCOTE} ${REF} -n ${N} -s ${SEED} -g ${IGNORE} -l ${SNP} -x ${FASTA} -b 1kb -j ${J} -r ${ADRATIO} -cwgd ${CWGD} -cwcl ${CWCL} -ccam ${CCAM} -ccna "${CFOC}" -swgd ${SWGD} -swcl ${SWCL} -scam ${SCAM} -scna "${SFOC}" |& tee ${FASTA}mascotte.log
+\time -v ${MASCOTE} ${REF} -n ${N} -s ${SEED} -g ${IGNORE} -l ${SNP} -x ${FASTA} -d -b 1kb -j ${J} -r ${ADRATIO} -cwgd ${CWGD} -cwcl ${CWCL} -ccam ${CCAM} -ccna "${CFOC}" -swgd ${SWGD} -swcl ${SWCL} -scam ${SCAM} -scna "${SFOC}" |& tee ${FASTA}mascotte.log
 
 
-echo -e "\033[1m\033[95m## Merging the haplotypes FASTA in unique diploid FASTA \033[0m"
-sed '/^>chr/ s/$/-A/' ${FASTA}human.maternal.fa > ${FASTA}normal.fa && sed '/^>chr/ s/$/-B/' ${FASTA}human.paternal.fa >> ${FASTA}normal.fa &
 TCLONES=""
 for (( i=0; i<${N}; i++ ))
 do
-    CLONE='clone'${i}
-    TCLONES="${TCLONES} ${BAM}${CLONE}.bam"
-    sed '/^>chr/ s/$/-A/' ${FASTA}${CLONE}.maternal.fa > ${FASTA}${CLONE}.fa && sed '/^>chr/ s/$/-B/' ${FASTA}${CLONE}.paternal.fa >> ${FASTA}${CLONE}.fa &
+    TCLONES="${TCLONES} ${BAM}clone${i}.bam"
 done
-wait
-
-
-echo -e "\033[1m\033[95m## Remove haplotype specific FASTA \033[0m"
-rm -rf ${FASTA}*.maternal.fa
-rm -rf ${FASTA}*.paternal.fa
 
 
 echo -e "\033[1m\033[95m## Simulating sequencing reads\033[0m"
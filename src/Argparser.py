@@ -15,15 +15,18 @@ def parse_mascotte_arguments():
     """
     description = "Simulate mixtures of distinct tumor clones characterized by copy-number aberrations (CNAs) resulted from an evolutionary process."
     parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('REFERENCE', type=str, help='A human-reference genome in FASTA format used to simulate a human genome and the descending tumor clones')
+    parser.add_argument('REFERENCE', type=str, help='A human-reference genome in FASTA or 2bit format used to simulate a human genome and the descending tumor clones')
     parser.add_argument('-n', '--numclones', type=int, required=True, help='The number of clones present in the mixture to simulate')
     parser.add_argument('-s', '--rndseed', type=int, required=False, default=None, help='The number of clones present in the mixture to simulate')
     parser.add_argument('-g', '--ignore', type=str, required=False, default=None, help='File-name containing a line-per-line list with chromosome names to ignore in the reference')
+    parser.add_argument('-R', '--regions', type=str, required=False, default=None, help=textwrap.dedent('A white-space separated list of contigs or intervals "CHR:START-END" (1-based and inclusive) of the reference\nto simulate, or a file containing one per line, such that only these are read through the index of the reference (default: all contigs not ignored)'))
     parser.add_argument('-l', '--snplist', type=str, required=False, default=None, help=textwrap.dedent('File-name containing a SNP positions to add in the simulate human genome in the\nformat "#CHR POSITION REF_ALLELES ALT_ALLELES" with first line as headline (default: SNPs are placed randomly)'))
     parser.add_argument('-p', '--snpratio', type=float, required=False, default=None, help='Ratio of SNPs to place randomly when a snplist is not given (default: None, snpratio is requried only whether SNPLIST is not provided)')
     parser.add_argument('-e', '--hehoratio', type=float, required=False, default=0.67, help='Ratio of heterozygous SNPs compared to homozygous ones (default: 0.67)')
     parser.add_argument('-x', '--runningdirectory', type=str, required=False, default='./', help='Running directory where resulting files and logs are created (default: current directory)')
+    parser.add_argument('-T', '--topology', type=str, required=False, default='random', choices=['random', 'coalescent', 'birthdeath', 'linear', 'star'], help='Topology of the tree describing the evolution of tumor clones, which is either a uniform random tree\n(random), built by coalescing random lineages (coalescent), by a birth-death process (birthdeath), a chain (linear), or a star (default: random)')
     parser.add_argument('-b', '--binsize', type=str, required=False, default='10kb', help='Size of bins to simulate tumor-clone genomes and corresponding CNAs (default: 10kb)')
+    parser.add_argument('-E', '--exact', action='store_true', default=False, required=False, help='Simulate CNAs with base-pair exact breakpoints by representing every haplotype as a list of intervals of the\nreference, in which case the bin size is not used (default: CNAs are simulated on bins)')
     parser.add_argument('-r', '--adratio', type=float, required=False, default=0.65, help='Proportion of amplification-deletion in the simulated events (default: 0.65)')
     parser.add_argument('-cwgd', '--clonalwgd', type=int, required=False, default=0, help='Number of clonal whole-genome duplications (WGDs) to introduce in the ancestor of tumor evolution (default: 0)')
     parser.add_argument('-cwcl', '--clonalwcl', type=int, required=False, default=0, help='Number of clonal whole-chromosome losses (WCLs) to introduce in the ancestor of tumor evolution (default: 0)')
@@ -33,28 +36,22 @@ def parse_mascotte_arguments():
     parser.add_argument('-swcl', '--subclonalwcl', type=int, required=False, default=0, help='Number of clonal whole-chromosome losses (WCLs) to introduce in subclonal branches of tumor evolution (default: 0)')
     parser.add_argument('-scam', '--subclonalcam', type=int, required=False, default=0, help='Number of clonal chromosomal-arm changes (CAMs) to introduce in subclonal branches of tumor evolution (default: 0)')
     parser.add_argument('-scna', '--subclonalcna', type=str, required=False, default=None, help=textwrap.dedent("A list of different types of subclonal focal copy-number aberrations to introduce in the ancestor of tumor\nevolution in the format 'MEAN_LENGTH:STD_DEVIATION:QUANTITY [MEAN_LENGTH:STD_DEVIATION:QUANTITY] where standard deviation can be omitted and is computed as 20%s of mean' (default: None)" % '%%'))
+    parser.add_argument('-w', '--linewidth', type=int, required=False, default=60, help='Number of bases per line in the generated FASTA files, which are indexed in corresponding .fai files, 0 writes\nevery sequence in a single line (default: 60)')
+    parser.add_argument('-z', '--compress', action='store_true', default=False, required=False, help='Write all the FASTA files compressed in BGZF format (.fa.gz) together with .fai and .gzi indexes, using the\nparallel jobs to compress (default: uncompressed FASTA files)')
+    parser.add_argument('-t', '--twobit', action='store_true', default=False, required=False, help='Write all the genomes in the compact UCSC 2bit format (.2bit) in place of FASTA files (default: FASTA files)')
+    parser.add_argument('-d', '--diploid', action='store_true', default=False, required=False, help='Write a single diploid FASTA file for the human genome (normal.fa) and for every tumor clone, where maternal\nand paternal chromosomes are named with the corresponding haplotype suffixes (default: two haplotype-specific FASTA files)')
+    parser.add_argument('-S', '--suffixes', type=str, required=False, default='-A,-B', help='Comma-separated suffixes appended to the names of maternal and paternal chromosomes in diploid FASTA files,\ne.g. --suffixes=-A,-B (default: -A,-B)')
+    parser.add_argument('-M', '--maxmemory', type=str, required=False, default=None, help='Maximum memory, optionally ending with "kb", "Mb", or "Gb", that the parallel jobs writing the genomes of tumor\nclones are estimated to use at the same time (default: None, no limit)')
+    parser.add_argument('-c', '--resume', action='store_true', default=False, required=False, help='Resume a previous run in the running directory from its checkpoints, such that the human genome and the tumor\nevolution are reloaded and only the stages not yet completed are executed (default: everything is simulated)')
     parser.add_argument('-j', '--jobs', type=int, required=False, default=1, help='The number of parallel jobs to use (default: 1)')
     parser.add_argument("-v", "--noverbose", action='store_false', default=True, required=False, help="Silence verbose log messages")
     args = parser.parse_args()
+    check_common_arguments(args)
 
-    if not os.path.isfile(args.REFERENCE):
-        raise ValueError(sp.error("The specified human reference-genome file does not exist!"))
     if args.numclones < 0:
         raise ValueError(sp.error("The number of clones must be a positive integer or zero, when only a matched-normal sample should be generated!"))
     if args.rndseed != None and args.rndseed < 0:
         raise ValueError(sp.error("The random seed must be a positive integer!"))
-    if args.ignore != None and not os.path.isfile(args.ignore):
-        raise ValueError(sp.error("The specified ignore-list file does not exist!"))
-    if args.snplist != None and not os.path.isfile(args.snplist):
-        raise ValueError(sp.error("The specified SNP-list file does not exist!"))
-    if args.snpratio != None and args.snpratio < 0.0 and args.snpratio > 1.0:
-        raise ValueError(sp.error("The SNP ratio must be in [0.0, 1.0]!"))
-    if args.hehoratio != None and args.hehoratio < 0.0 and args.snpratio > 1.0:
-        raise ValueError(sp.error("The heterozygous-homozygous ratio must be in [0.0, 1.0]!"))
-    if args.adratio < 0.0 and args.adratio > 1.0:
-        raise ValueError(sp.error("The SNP ratio must be in [0.0, 1.0]!"))
-    if not os.path.isdir(args.runningdirectory):
-        raise ValueError(sp.error("The specified running directory does not exist!"))
     if args.clonalwgd < 0:
         raise ValueError(sp.error("The number of clonal WGD must be a positive integer!"))
     if args.clonalwcl < 0:
@@ -67,12 +64,10 @@ def parse_mascotte_arguments():
         raise ValueError(sp.error("The number of subclonal WCL must be a positive integer!"))
     if args.subclonalcam < 0:
         raise ValueError(sp.error("The number of subclonal CAM must be a positive integer!"))
-    if args.jobs <= 0:
-        raise ValueError(sp.error("The number of jobs must be a non-zero positive integer!"))
 
-    if args.clonalcna != None and sum(len(event.split(':')) != 2 and len(event.split(':')) != 3 for event in args.clonalcna.split()) > 0:
+    if args.clonalcna != None and not check_focal(args.clonalcna):
         raise ValueError(sp.error('The clonal focal CNAs are given in wrong format!'))
-    if args.subclonalcna != None and sum(len(event.split(':')) != 2 and len(event.split(':')) != 3 for event in args.subclonalcna.split()) > 0:
+    if args.subclonalcna != None and not check_focal(args.subclonalcna):
         raise ValueError(sp.error('The subclonal focal CNAs are given in wrong format!'))
 
     mutations = {}
@@ -81,32 +76,27 @@ def parse_mascotte_arguments():
     mutations['clonalwgd'] = args.clonalwgd
     mutations['clonalwcl'] = args.clonalwcl
     mutations['clonalcam'] = args.clonalcam
-    mutations['clonalfocal'] = {}
-    if args.clonalcna != None:
-        mutations['clonalfocal'] = {(sp.basesize(event.split(':')[0]), sp.basesize(event.split(':')[1])) if len(event.split(':')) == 3 else (sp.basesize(event.split(':')[0]), int(sp.basesize(event.split(':')[0]) * 0.2)) : int(event.split(':')[2]) if len(event.split(':')) == 3 else int(event.split(':')[1]) for event in args.clonalcna.strip().split()}
+    mutations['clonalfocal'] = parse_focal(args.clonalcna)
 
     mutations['subclonalwgd'] = args.subclonalwgd
     mutations['subclonalwcl'] = args.subclonalwcl
     mutations['subclonalcam'] = args.subclonalcam
-    mutations['subclonalfocal'] = {}
-    if args.subclonalcna != None:
-        mutations['subclonalfocal'] = {(sp.basesize(event.split(':')[0]), sp.basesize(event.split(':')[1])) if len(event.split(':')) == 3 else (sp.basesize(event.split(':')[0]), int(sp.basesize(event.split(':')[0]) * 0.2)) : int(event.split(':')[2]) if len(event.split(':')) == 3 else int(event.split(':')[1]) for event in args.subclonalcna.strip().split()}
+    mutations['subclonalfocal'] = parse_focal(args.subclonalcna)
 
-    if args.snplist == None and args.snpratio == None:
-        raise ValueError(sp.error('One among SNP list and SNP ratio must be provided!'))
 
-    ignorelist = []
-    if args.ignore != None:
-        with open(args.ignore) as f:
-            for line in f:
-                if line != '':
-                    ignorelist.append(line.strip())
+    ignorelist = parse_ignorelist(args.ignore)
+    regions = parse_regions(args.regions)
+    suffixes = parse_suffixes(args.suffixes)
 
-    binsize = sp.basesize(args.binsize)
+    binsize = sp.basesize(args.binsize) if not args.exact else None
+    maxmemory = sp.basesize(args.maxmemory) if args.maxmemory != None else None
+    if maxmemory != None and maxmemory <= 0:
+        raise ValueError(sp.error("The maximum memory must be a positive size!"))
 
     return {'reference' : args.REFERENCE,
             'numclones' : args.numclones,
             'ignore' : ignorelist,
+            'regions' : regions,
             'snplist' : args.snplist,
             'snpratio' : args.snpratio,
             'HEHOratio' : args.hehoratio,
@@ -115,5 +105,181 @@ def parse_mascotte_arguments():
             'rndseed' : args.rndseed,
             'mutations' : mutations,
             'binsize' : binsize,
+            'topology' : args.topology,
+            'linewidth' : args.linewidth,
+            'compress' : args.compress,
+            'suffixes' : suffixes if args.diploid else None,
+            'twobit' : args.twobit,
+            'maxmemory' : maxmemory,
+            'resume' : args.resume,
+            'jobs' : args.jobs,
+            'noverbose' : args.noverbose}
+
+
+def parse_batch_arguments():
+    """
+    Parse command line arguments of a batch of replicates
+    Returns:
+    """
+    description = "Simulate a batch of tumors for a sweep of parameters, all descending from a single human genome which is simulated once."
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('REFERENCE', type=str, help='A human-reference genome in FASTA or 2bit format used to simulate a human genome and the descending tumor clones')
+    parser.add_argument('-n', '--numclones', type=str, required=True, help='Comma-separated list of the numbers of clones to simulate in the sweep')
+    parser.add_argument('-s', '--rndseeds', type=str, required=False, default=None, help='Comma-separated list of random seeds, every combination of parameters is simulated once for each seed\n(default: random seeds drawn according to the number of replicates)')
+    parser.add_argument('-N', '--replicates', type=int, required=False, default=1, help='Number of replicates of every combination of parameters, with random seeds drawn when not given (default: 1)')
+    parser.add_argument('-H', '--humanseed', type=int, required=False, default=None, help='Random seed used to simulate the human genome and to draw the seeds of the replicates (default: None)')
+    parser.add_argument('-g', '--ignore', type=str, required=False, default=None, help='File-name containing a line-per-line list with chromosome names to ignore in the reference')
+    parser.add_argument('-R', '--regions', type=str, required=False, default=None, help=textwrap.dedent('A white-space separated list of contigs or intervals "CHR:START-END" (1-based and inclusive) of the reference\nto simulate, or a file containing one per line (default: all contigs not ignored)'))
+    parser.add_argument('-l', '--snplist', type=str, required=False, default=None, help='File-name containing a SNP positions to add in the simulate human genome (default: SNPs are placed randomly)')
+    parser.add_argument('-p', '--snpratio', type=float, required=False, default=None, help='Ratio of SNPs to place randomly when a snplist is not given (default: None)')
+    parser.add_argument('-e', '--hehoratio', type=float, required=False, default=0.67, help='Ratio of heterozygous SNPs compared to homozygous ones (default: 0.67)')
+    parser.add_argument('-x', '--runningdirectory', type=str, required=False, default='./', help='Running directory where the human genome, the manifest, and a directory for every replicate are created\n(default: current directory)')
+    parser.add_argument('-T', '--topology', type=str, required=False, default='random', choices=['random', 'coalescent', 'birthdeath', 'linear', 'star'], help='Topology of the tree describing the evolution of tumor clones (default: random)')
+    parser.add_argument('-b', '--binsize', type=str, required=False, default='10kb', help='Size of bins to simulate tumor-clone genomes and corresponding CNAs (default: 10kb)')
+    parser.add_argument('-E', '--exact', action='store_true', default=False, required=False, help='Simulate CNAs with base-pair exact breakpoints (default: CNAs are simulated on bins)')
+    parser.add_argument('-r', '--adratio', type=float, required=False, default=0.65, help='Proportion of amplification-deletion in the simulated events (default: 0.65)')
+    parser.add_argument('-cwgd', '--clonalwgd', type=str, required=False, default='0', help='Comma-separated list of the numbers of clonal WGDs (default: 0)')
+    parser.add_argument('-cwcl', '--clonalwcl', type=str, required=False, default='0', help='Comma-separated list of the numbers of clonal WCLs (default: 0)')
+    parser.add_argument('-ccam', '--clonalcam', type=str, required=False, default='0', help='Comma-separated list of the numbers of clonal CAMs (default: 0)')
+    parser.add_argument('-ccna', '--clonalcna', type=str, required=False, default=None, help=textwrap.dedent("Comma-separated list of the clonal focal CNAs, each given as in mascotte.py, e.g. '20Mb:5 1Mb:30,10Mb:10'\n(default: None)"))
+    parser.add_argument('-swgd', '--subclonalwgd', type=str, required=False, default='0', help='Comma-separated list of the numbers of subclonal WGDs (default: 0)')
+    parser.add_argument('-swcl', '--subclonalwcl', type=str, required=False, default='0', help='Comma-separated list of the numbers of subclonal WCLs (default: 0)')
+    parser.add_argument('-scam', '--subclonalcam', type=str, required=False, default='0', help='Comma-separated list of the numbers of subclonal CAMs (default: 0)')
+    parser.add_argument('-scna', '--subclonalcna', type=str, required=False, default=None, help=textwrap.dedent("Comma-separated list of the subclonal focal CNAs, each given as in mascotte.py (default: None)"))
+    parser.add_argument('-w', '--linewidth', type=int, required=False, default=60, help='Number of bases per line in the generated FASTA files (default: 60)')
+    parser.add_argument('-z', '--compress', action='store_true', default=False, required=False, help='Write all the FASTA files compressed in BGZF format (.fa.gz) (default: uncompressed FASTA files)')
+    parser.add_argument('-t', '--twobit', action='store_true', default=False, required=False, help='Write all the genomes in the compact UCSC 2bit format (.2bit) (default: FASTA files)')
+    parser.add_argument('-d', '--diploid', action='store_true', default=False, required=False, help='Write a single diploid FASTA file for the human genome and for every tumor clone (default: two haplotype-specific\nFASTA files)')
+    parser.add_argument('-S', '--suffixes', type=str, required=False, default='-A,-B', help='Comma-separated suffixes of maternal and paternal chromosomes in diploid FASTA files (default: -A,-B)')
+    parser.add_argument('-c', '--resume', action='store_true', default=False, required=False, help='Resume a previous batch from the checkpoints of the human genome and of every replicate (default: everything\nis simulated)')
+    parser.add_argument('-j', '--jobs', type=int, required=False, default=1, help='The number of parallel jobs to use, where every replicate is simulated by a single job (default: 1)')
+    parser.add_argument("-v", "--noverbose", action='store_false', default=True, required=False, help="Silence verbose log messages")
+    args = parser.parse_args()
+    check_common_arguments(args)
+
+    if args.humanseed != None and args.humanseed < 0:
+        raise ValueError(sp.error("The random seed must be a positive integer!"))
+    if args.replicates <= 0:
+        raise ValueError(sp.error("The number of replicates must be a non-zero positive integer!"))
+
+    # Every swept parameter is a list of values, whose combinations are all simulated
+    sweep = {}
+    for name in ['numclones', 'clonalwgd', 'clonalwcl', 'clonalcam', 'subclonalwgd', 'subclonalwcl', 'subclonalcam']:
+        try:
+            sweep[name] = [int(value) for value in getattr(args, name).split(',')]
+        except ValueError:
+            raise ValueError(sp.error('The values of {} must be a comma-separated list of integers!'.format(name)))
+        if sum(value < 0 for value in sweep[name]) > 0:
+            raise ValueError(sp.error('The values of {} must be positive integers!'.format(name)))
+    for name in ['clonalcna', 'subclonalcna']:
+        sweep[name] = [spec.strip() for spec in getattr(args, name).split(',')] if getattr(args, name) != None else ['']
+        if sum(not check_focal(spec) for spec in sweep[name]) > 0:
+            raise ValueError(sp.error('The focal CNAs of {} are given in wrong format!'.format(name)))
+
+    rndseeds = None
+    if args.rndseeds != None:
+        rndseeds = [int(seed) for seed in args.rndseeds.split(',')]
+        if sum(seed < 0 for seed in rndseeds) > 0:
+            raise ValueError(sp.error("The random seeds must be positive integers!"))
+
+    ignorelist = parse_ignorelist(args.ignore)
+    regions = parse_regions(args.regions)
+    suffixes = parse_suffixes(args.suffixes)
+
+    return {'reference' : args.REFERENCE,
+            'sweep' : sweep,
+            'rndseeds' : rndseeds,
+            'replicates' : args.replicates,
+            'humanseed' : args.humanseed,
+            'ignore' : ignorelist,
+            'regions' : regions,
+            'snplist' : args.snplist,
+            'snpratio' : args.snpratio,
+            'HEHOratio' : args.hehoratio,
+            'adratio' : args.adratio,
+            'xdir' : args.runningdirectory,
+            'binsize' : sp.basesize(args.binsize) if not args.exact else None,
+            'topology' : args.topology,
+            'linewidth' : args.linewidth,
+            'compress' : args.compress,
+            'suffixes' : suffixes if args.diploid else None,
+            'twobit' : args.twobit,
+            'maxmemory' : None,
+            'resume' : args.resume,
             'jobs' : args.jobs,
             'noverbose' : args.noverbose}
+
+
+def check_focal(spec):
+    return sum(len(event.split(':')) != 2 and len(event.split(':')) != 3 for event in spec.split()) == 0
+
+
+def parse_focal(spec):
+    # Focal CNAs given as 'MEAN_LENGTH:QUANTITY' or 'MEAN_LENGTH:STD_DEVIATION:QUANTITY', where the standard deviation is
+    # 20% of the mean length when omitted
+    focal = {}
+    if spec != None:
+        for event in spec.strip().split():
+            fields = event.split(':')
+            if len(fields) == 3:
+                focal[sp.basesize(fields[0]), sp.basesize(fields[1])] = int(fields[2])
+            else:
+                focal[sp.basesize(fields[0]), int(sp.basesize(fields[0]) * 0.2)] = int(fields[1])
+    return focal
+
+
+def check_common_arguments(args):
+    # Checks of the arguments shared by mascotte.py and mascottebatch.py
+    if not os.path.isfile(args.REFERENCE):
+        raise ValueError(sp.error("The specified human reference-genome file does not exist!"))
+    if args.ignore != None and not os.path.isfile(args.ignore):
+        raise ValueError(sp.error("The specified ignore-list file does not exist!"))
+    if args.snplist != None and not os.path.isfile(args.snplist):
+        raise ValueError(sp.error("The specified SNP-list file does not exist!"))
+    if args.snplist == None and args.snpratio == None:
+        raise ValueError(sp.error('One among SNP list and SNP ratio must be provided!'))
+    if args.snpratio != None and (args.snpratio < 0.0 or args.snpratio > 1.0):
+        raise ValueError(sp.error("The SNP ratio must be in [0.0, 1.0]!"))
+    if args.hehoratio != None and (args.hehoratio < 0.0 or args.hehoratio > 1.0):
+        raise ValueError(sp.error("The heterozygous-homozygous ratio must be in [0.0, 1.0]!"))
+    if args.adratio < 0.0 or args.adratio > 1.0:
+        raise ValueError(sp.error("The amplification-deletion ratio must be in [0.0, 1.0]!"))
+    if not os.path.isdir(args.runningdirectory):
+        raise ValueError(sp.error("The specified running directory does not exist!"))
+    if args.linewidth < 0:
+        raise ValueError(sp.error("The line width must be a positive integer or zero!"))
+    if args.twobit and args.compress:
+        raise ValueError(sp.error("The genomes can be either compressed or written in 2bit format, but not both!"))
+    if args.jobs <= 0:
+        raise ValueError(sp.error("The number of jobs must be a non-zero positive integer!"))
+
+
+def parse_ignorelist(filename):
+    ignorelist = []
+    if filename != None:
+        with open(filename) as f:
+            for line in f:
+                if line != '':
+                    ignorelist.append(line.strip())
+    return ignorelist
+
+
+def parse_regions(value):
+    # Regions are given either as a white-space separated list or as a file with one per line
+    regions = None
+    if value != None:
+        if os.path.isfile(value):
+            with open(value) as f:
+                regions = [sp.parseRegion(line.strip()) for line in f if line.strip() != '']
+        else:
+            regions = [sp.parseRegion(region) for region in value.split()]
+        if len(regions) == 0:
+            raise ValueError(sp.error('At least one region must be specified when regions are given!'))
+    return regions
+
+
+def parse_suffixes(value):
+    suffixes = tuple(value.split(','))
+    if len(suffixes) != 2 or suffixes[0] == suffixes[1]:
+        raise ValueError(sp.error('The haplotype suffixes must be two different values separated by a comma!'))
+    return suffixes
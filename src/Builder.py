@@ -1,25 +1,35 @@
 import os
 import copy
+import mmap
+import shutil
+import tempfile
+from collections import Counter
 from multiprocessing import Process, Queue, JoinableQueue, Lock, Value
 
+import Formats
+import Support
+
 
 class CloneGenomeBuilder:
 
-    def __init__(self, tumor, xdir):
+    def __init__(self, tumor, xdir, width=60, compress=False, suffixes=None, twobit=False):
         self.tumor = tumor
         self.xdir = xdir
+        self.width = width
+        self.compress = compress
+        self.suffixes = suffixes
+        self.twobit = twobit
 
-    def parallelbuild(self, numworkers):
+    def parallelbuild(self, numworkers, maxmemory=None):
 
         class Worker(Process):
 
-            def __init__(self, task_queue, results, chromosomes, reference, lengths):
+            def __init__(self, task_queue, results, human, width):
                 Process.__init__(self)
                 self.task_queue = task_queue
                 self.result_queue = results
-                self.chromosomes = chromosomes
-                self.reference = reference
-                self.lengths = lengths
+                self.human = human
+                self.width = width
 
             def run(self):
                 while True:
@@ -28,90 +38,206 @@ class CloneGenomeBuilder:
                         # Poison pill means shutdown
                         self.task_queue.task_done()
                         break
-                    self.buildHaplotype(next_task)
+                    idx, function, task = next_task
+                    self.result_queue.put((idx, function(self.human, self.width, task)))
                     self.task_queue.task_done()
-                    self.result_queue.put(next_task[-1])
                 return
 
-            def buildChromosome(self, sequence, haplotype, reference):
-                referencesequence = {bi : sequence[bi[0]:bi[1]] for bi in reference}
-                result = ''
-                for bi in haplotype:
-                    result += ''.join(referencesequence[bi])
-                return result
-
-            def buildHaplotype(self, task):
-                originalfa, haplotypes, haplengths, output = task
-                with open(originalfa, 'r') as fa:
-                    with open(output, 'w') as out:
-                        name = ''
-                        sequence = []
-                        for line in fa:
-                            if line != '':
-                                if line[0] == '>':
-                                    if name != '' and name in self.chromosomes and haplengths[name] > 0:
-                                        out.write(">{}\n".format(name))
-                                        assert(len(sequence) == self.lengths[name])
-                                        out.write("{}\n".format(self.buildChromosome(sequence, haplotypes[name], self.reference[name])))
-                                    name = line.strip()[1:]
-                                    sequence = []
-                                else:
-                                    if name in self.chromosomes and haplengths[name] > 0:
-                                        sequence += list(line.strip())
-                        if len(sequence) > 0:
-                            if name != '' and name in self.chromosomes:
-                                out.write(">{}\n".format(name))
-                                assert(len(sequence) == self.lengths[name])
-                                out.write("{}\n".format(self.buildChromosome(sequence, haplotypes[name], self.reference[name])))
-
-        # Establish communication queues
-        tasks = JoinableQueue()
-        results = Queue()
-
-        # Enqueue jobs
+        # Every haplotype of a chromosome is first materialized once into a packed file, which is shared read-only
+        # through a memory map by the tasks writing the corresponding records for batches of clones
         c = copy.deepcopy
-        jobs_count = 0
+        chromosomes = self.tumor.human.chromosomes
+        staging = tempfile.mkdtemp(prefix='.staging', dir=self.xdir)
+        groups = []
+        # Clones sharing the same layout of a chromosome haplotype, e.g. inherited untouched, share a single layout
+        numlayouts = 0
+        lengths = {}
+        for idx, chro in enumerate(chromosomes):
+            for allele, name in (('m', 'maternal'), ('p', 'paternal')):
+                layouts = []
+                unique = {}
+                shared = {}
+                for clone in self.tumor.clones:
+                    length = clone.genome[chro].maternalHaplotypeLength if allele == 'm' else clone.genome[chro].paternalHaplotypeLength
+                    if length > 0:
+                        # Chromosomes shared copy-on-write between clones have the same layout
+                        if not id(clone.genome[chro]) in shared:
+                            haplotype = clone.genome[chro].maternalHaplotype if allele == 'm' else clone.genome[chro].paternalHaplotype
+                            shared[id(clone.genome[chro])] = tuple(clone.genome[chro].runs(haplotype))
+                        runs = shared[id(clone.genome[chro])]
+                        lengths[chro, allele, clone.label] = length
+                        numlayouts += 1
+                        if runs in unique:
+                            unique[runs][0].append(c(clone.label))
+                        else:
+                            unique[runs] = ([c(clone.label)], runs, os.path.join(self.xdir, '{}.{}.{}.part'.format(clone.label, name, idx)))
+                            layouts.append(unique[runs])
+                if len(layouts) > 0:
+                    groups.append((chro, allele, os.path.join(staging, '{}.{}.seq'.format(idx, name)), layouts))
+
+        # The records of every clone are in reference order, first maternal and then paternal chromosomes when both are
+        # written in a diploid FASTA file, while chromosomes lost in a haplotype are omitted
+        suffixes = self.suffixes if self.suffixes != None else ('', '')
+        outputs = []
         for clone in self.tumor.clones:
-            originalfa = c(clone.humanGenome.maternalfa)
-            haplotypes = {c(chro) : c(clone.genome[chro].maternalHaplotype) for chro in clone.humanGenome.chromosomes}
-            haplengths = {c(chro) : c(clone.genome[chro].maternalHaplotypeLength) for chro in clone.humanGenome.chromosomes}
-            output = os.path.join(self.xdir, '{}.maternal.fa'.format(c(clone.label)))
-            tasks.put((originalfa, haplotypes, haplengths, output))
-            jobs_count += 1
-
-            originalfa = c(clone.humanGenome.paternalfa)
-            haplotypes = {c(chro) : c(clone.genome[chro].paternalHaplotype) for chro in clone.humanGenome.chromosomes}
-            haplengths = {c(chro) : c(clone.genome[chro].paternalHaplotypeLength) for chro in clone.humanGenome.chromosomes}
-            output = os.path.join(self.xdir, '{}.paternal.fa'.format(c(clone.label)))
-            tasks.put((originalfa, haplotypes, haplengths, output))
-            jobs_count += 1
-
-        # Setting up the workers
-        workers = [Worker(task_queue=tasks, results=results, chromosomes=c(self.tumor.human.chromosomes), reference={c(chro) : c(self.tumor.root.genome[chro].reference) for chro in self.tumor.human.chromosomes}, lengths={c(chro) : c(self.tumor.root.genome[chro].length) for chro in self.tumor.human.chromosomes}) for i in range(min(numworkers, jobs_count))]
-
-        # Add a poison pill for each worker
-        for i in range(len(workers)):
-            tasks.put(None)
-
-        # Start the workers
-        for w in workers:
-            w.start()
-
-        # Wait for all of the tasks to finish
-        tasks.join()
-
-        # Collect results
-        collect = []
-        for i in range(jobs_count):
-            collect.append(results.get())
-
-        # Close Queues
-        tasks.close()
-        results.close()
+            for allele, name, suffix in (('m', 'maternal', suffixes[0]), ('p', 'paternal', suffixes[1])):
+                records = [(chro + suffix, (chro, allele, clone.label)) for chro in chromosomes if (chro, allele, clone.label) in lengths]
+                if len(outputs) > 0 and outputs[-1][0] == self.output(clone, name):
+                    outputs[-1][1].extend(records)
+                else:
+                    outputs.append((self.output(clone, name), records))
+
+        # Uncompressed FASTA records are written directly in the final files at their offsets, which are known from the
+        # lengths of the layouts, while 2bit and compressed records are written in parts that are then concatenated
+        direct = not self.compress and not self.twobit
+        if direct:
+            targets = {}
+            for output, records in outputs:
+                offsets = Formats.allocate(output, [(name, lengths[key]) for name, key in records], width=self.width)
+                targets.update((key, (output, name, offset)) for (name, key), offset in zip(records, offsets))
+            groups = [(chro, allele, packed, [(labels, runs, [targets[chro, allele, label] for label in labels]) for labels, runs, part in layouts]) for chro, allele, packed, layouts in groups]
+        else:
+            groups = [(chro, allele, packed, [(labels, runs, [(part, None, None)]) for labels, runs, part in layouts]) for chro, allele, packed, layouts in groups]
+
+        stages = [(chro, allele, packed) for chro, allele, packed, layouts in groups]
+        numbatches = max(1, -(-numworkers // max(1, len(groups))))
+        writes = [[(chro, allele, packed, layouts[b::numbatches], self.twobit) for b in range(min(numbatches, len(layouts)))] for chro, allele, packed, layouts in groups]
+
+        if numworkers == 1:
+            collect = []
+            for stage, group in zip(stages, writes):
+                stageHaplotype(self.tumor.human, self.width, stage)
+                collect.extend(buildChromosome(self.tumor.human, self.width, task) for task in group)
+                os.remove(stage[2])
+        else:
+            # Establish communication queues
+            tasks = JoinableQueue()
+            results = Queue()
+
+            # Setting up the workers
+            workers = [Worker(task_queue=tasks, results=results, human=self.tumor.human, width=self.width) for i in range(min(numworkers, sum(len(group) for group in writes)))]
+
+            # Start the workers
+            for w in workers:
+                w.start()
+
+            collect = self.schedule(stages, writes, tasks, results, len(workers), maxmemory)
+
+            # Add a poison pill for each worker
+            for i in range(len(workers)):
+                tasks.put(None)
+
+            # Wait for all of the tasks to finish
+            tasks.join()
+
+            # Close Queues
+            tasks.close()
+            results.close()
+
+            # Ensure each worker terminates
+            for w in workers:
+                w.terminate()
+                w.join()
+        shutil.rmtree(staging)
+
+        Support.log(msg='Distinct chromosome-haplotype layouts written for tumor clones: {} out of {}\n'.format(sum(len(group[3]) for group in groups), numlayouts), level='INFO')
+
+        if not direct:
+            # Every part is removed as soon as the last output containing it has been written
+            parts = {(chro, allele, label) : (length, part) for result in collect for chro, allele, label, length, part in result}
+            consumers = Counter(parts[key][1] for output, records in outputs for name, key in records)
+            for output, records in outputs:
+                Formats.concatenate([(output, [(name, parts[key][1], parts[key][0]) for name, key in records])], width=self.width, compress=self.compress, threads=numworkers, twobit=self.twobit)
+                for name, key in records:
+                    consumers[parts[key][1]] -= 1
+                    if consumers[parts[key][1]] == 0:
+                        os.remove(parts[key][1])
 
-        # Ensure each worker terminates
-        for w in workers:
-            w.terminate()
-            w.join()
+        return collect
 
+    def output(self, clone, haplotype):
+        ext = '.2bit' if self.twobit else ('.fa.gz' if self.compress else '.fa')
+        if self.suffixes != None:
+            return os.path.join(self.xdir, '{}{}'.format(clone.label, ext))
+        return os.path.join(self.xdir, '{}.{}{}'.format(clone.label, haplotype, ext))
+
+    def schedule(self, stages, writes, tasks, results, numworkers, maxmemory):
+        # Every haplotype is staged before the tasks writing it, which are preferred to new stages such that a staged
+        # haplotype is removed as soon as all its writes are done. Tasks of larger chromosomes are started first and
+        # only when the estimated memory of the running tasks does not exceed the given budget, such that smaller tasks
+        # fill the remaining budget
+        length = (lambda job : self.tumor.human.lengths[stages[job[1]][0]])
+        task = (lambda job : stages[job[1]] if job[0] == 'stage' else writes[job[1]][job[2]])
+        function = (lambda job : stageHaplotype if job[0] == 'stage' else buildChromosome)
+        pending = sorted([('stage', g) for g in range(len(stages))], key=length, reverse=True)
+        remaining = [len(group) for group in writes]
+        running = {}
+        collect = []
+        while len(pending) > 0 or len(running) > 0:
+            available = None if maxmemory == None else maxmemory - sum(running.values())
+            fit = None
+            if len(running) < numworkers and len(pending) > 0:
+                fit = next((job for job in pending if available == None or self.memory(task(job)) <= available), None)
+                if fit == None and len(running) == 0:
+                    fit = pending[0]
+                    Support.log(msg='The estimated memory {} for building {} exceeds the given maximum memory\n'.format(self.memory(task(fit)), task(fit)[0]), level='WARN')
+            if fit != None:
+                pending.remove(fit)
+                running[fit] = self.memory(task(fit))
+                tasks.put((fit, function(fit), task(fit)))
+            else:
+                done, result = results.get()
+                del running[done]
+                if done[0] == 'stage':
+                    jobs = [('write', done[1], i) for i in range(len(writes[done[1]]))]
+                    pending = sorted([job for job in pending if job[0] == 'write'] + jobs, key=length, reverse=True) + [job for job in pending if job[0] == 'stage']
+                else:
+                    collect.append(result)
+                    remaining[done[1]] -= 1
+                    if remaining[done[1]] == 0:
+                        os.remove(stages[done[1]][2])
         return collect
+
+    def memory(self, task):
+        # Haplotypes are memory mapped, such that a stage holds a block of bases and its copy with the SNPs, a FASTA write
+        # holds a block of wrapped lines and their slices, and a 2bit write holds a chunk of bases in a few packed forms
+        # together with the tables of N and lower-case blocks of a layout, assumed to be at most one every 128 bases
+        if len(task) == 3:
+            return 2 * Formats.BLOCKSIZE
+        chro, allele, packed, layouts, twobit = task
+        if twobit:
+            longest = max(sum(end - start for start, end in runs) for labels, runs, targets in layouts)
+            return 8 * Formats.TwoBitWriter.CHUNK + 24 * (longest // 128)
+        return (1 << 16) * (2 * self.width + 38)
+
+
+def stageHaplotype(human, width, task):
+    chro, allele, packed = task
+    with open(packed, 'wb') as out:
+        for block in human.materialize(chro, allele, 0, human.lengths[chro]):
+            out.write(block)
+    return packed
+
+
+def buildChromosome(human, width, task):
+    chro, allele, packed, layouts, twobit = task
+    with open(packed, 'rb') as f:
+        sequence = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    assert(len(sequence) == human.lengths[chro])
+    result = []
+    for labels, runs, targets in layouts:
+        # Every target is either a part written without name or a named record at an offset of a reserved FASTA file,
+        # where the layout is wrapped once in the first target and its bytes are copied to the records of other clones
+        output, name, offset = targets[0]
+        with Formats.writer(output, width=width, index=False, twobit=twobit, offset=offset) as out:
+            out.start(name)
+            for start, end in runs:
+                out.append(buffer(sequence, start, end - start))
+            body = out.start_offset if len(targets) > 1 else None
+            length = out.end()
+        for target, name, offset in targets[1:]:
+            with Formats.writer(target, width=width, index=False, offset=offset) as out:
+                out.copy(name, output, length, offset=body)
+        result.extend((chro, allele, label, length, targets[0][0]) for label in labels)
+    sequence.close()
+    return result
@@ -0,0 +1,106 @@
+import os
+import zlib
+import cPickle as pickle
+from array import array
+
+import Genomics
+import Evolution
+import Support
+
+
+VERSION = 2
+KINDS = ['wgd', 'wcl', 'dup', 'del', 'armdup', 'armdel']
+# Arguments that a resumed run must share with the run that wrote the checkpoints
+HUMANARGS = ['reference', 'snplist', 'snpratio', 'HEHOratio', 'ignore', 'regions', 'rndseed', 'linewidth', 'compress', 'twobit', 'suffixes']
+TUMORARGS = ['numclones', 'binsize', 'mutations', 'topology', 'rndseed']
+
+
+def save(filename, state):
+    # States are pickled and compressed, and the file is replaced atomically such that a crash never leaves a
+    # truncated checkpoint
+    state = dict(state, version=VERSION)
+    partial = '{}.tmp'.format(filename)
+    with open(partial, 'wb') as o:
+        o.write(zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL), 6))
+    os.rename(partial, filename)
+
+
+def load(filename):
+    with open(filename, 'rb') as i:
+        state = pickle.loads(zlib.decompress(i.read()))
+    if state.get('version') != VERSION:
+        raise ValueError(Support.error('The checkpoint {} has been written by an incompatible version!'.format(filename)))
+    return state
+
+
+def arguments(args, names):
+    # Paths are absolute such that runs can be resumed from any working directory
+    paths = ['reference', 'snplist', 'xdir']
+    return {name : os.path.abspath(args[name]) if name in paths and args[name] != None else args[name] for name in names}
+
+
+def check(filename, state, args, names):
+    given = arguments(args, names + ['xdir'])
+    mismatches = [name for name in names if state['args'][name] != given[name]]
+    if len(mismatches) > 0:
+        raise ValueError(Support.error('The arguments {} differ from those of the run checkpointed in {}, which cannot be resumed with them!'.format(', '.join(mismatches), filename)))
+    if state['args']['xdir'] != given['xdir']:
+        Support.log('The checkpoint {} has been written in the running directory {}\n'.format(filename, state['args']['xdir']), level='WARN')
+
+
+def saveHuman(filename, human, args):
+    # Arrays are stored as raw bytes which are much more compact than pickled arrays
+    snps = {chro : (human.snps[chro][0].tostring(), str(human.snps[chro][1]), str(human.snps[chro][2])) for chro in human.chromosomes}
+    save(filename, {'args' : arguments(args, HUMANARGS + ['xdir']), 'reference' : os.path.abspath(human.reference),
+                    'snpratio' : human.snpratio, 'HEHOratio' : human.HEHOratio, 'ignorelist' : human.ignorelist,
+                    'regions' : human.regions, 'contigs' : human.contigs, 'chromosomes' : human.chromosomes,
+                    'lengths' : human.lengths, 'maternalfa' : os.path.abspath(human.maternalfa),
+                    'paternalfa' : os.path.abspath(human.paternalfa), 'numsnps' : human.numsnps, 'hetsnps' : human.hetsnps,
+                    'snps' : snps})
+
+
+def loadHuman(filename, args):
+    state = load(filename)
+    check(filename, state, args, HUMANARGS)
+    human = Genomics.HumanGenome(reference=state['reference'], snplist=None, snpratio=state['snpratio'], HEHOratio=state['HEHOratio'], ignorelist=state['ignorelist'], regions=state['regions'])
+    human.contigs = state['contigs']
+    human.chromosomes = state['chromosomes']
+    human.lengths = state['lengths']
+    human.maternalfa = state['maternalfa']
+    human.paternalfa = state['paternalfa']
+    human.numsnps = state['numsnps']
+    human.hetsnps = state['hetsnps']
+    for chro in human.chromosomes:
+        positions, maternal, paternal = state['snps'][chro]
+        human.snps[chro] = (array('l', positions), bytearray(maternal), bytearray(paternal))
+    return human
+
+
+def saveTumor(filename, tumor, args, stages=()):
+    # Only the tree and the event log of every clone are stored, every event as 5 integers with the kind, the index of
+    # the chromosome, the allele, the start, and the size
+    index = {chro : i for i, chro in enumerate(tumor.human.chromosomes)}
+    events = []
+    for clone in tumor.clones:
+        log = array('l')
+        for kind, chromosome, allele, start, size in clone.events:
+            log.extend((KINDS.index(kind), index.get(chromosome, -1), ('m', 'p').index(allele) if allele != None else -1, start, size))
+        events.append(log.tostring())
+    save(filename, {'args' : arguments(args, TUMORARGS + ['xdir']), 'binsize' : tumor.binsize, 'labels' : [clone.label for clone in tumor.clones], 'stages' : list(stages),
+                    'children' : [[child.idx for child in clone.children] for clone in tumor.clones], 'events' : events})
+
+
+def loadTumor(filename, human, args):
+    # The genomes of the clones are rebuilt by replaying their events in pre-order on the genomes of their parents
+    state = load(filename)
+    check(filename, state, args, TUMORARGS)
+    tumor = Evolution.RandomTree(n=len(state['labels']), humanGenome=human, binsize=state['binsize'], labels=state['labels'], children=state['children'])
+    stack = [tumor.root]
+    while len(stack) > 0:
+        clone = stack.pop()
+        if clone.parent != None:
+            clone.inherit(clone.parent)
+        log = array('l', state['events'][clone.idx])
+        clone.replay((KINDS[log[k]], human.chromosomes[log[k + 1]] if log[k + 1] >= 0 else None, ('m', 'p')[log[k + 2]] if log[k + 2] >= 0 else None, log[k + 3], log[k + 4]) for k in xrange(0, len(log), 5))
+        stack.extend(reversed(clone.children))
+    return tumor, state['stages']
@@ -1,14 +1,17 @@
 
+import heapq
 import random
+from collections import Counter
 
-from Genomics import Clone
+from Genomics import Clone, germline
 
 
 class RandomTree:
 
-    def __init__(self, n, humanGenome, binsize, labels=None):
+    def __init__(self, n, humanGenome, binsize, labels=None, topology='random', children=None):
         self.n = n
         self.human = humanGenome
+        self.binsize = binsize
         if self.n <= 0:
             raise ValueError("A tree cannot be built with 0 or negative number of nodes!")
         if labels != None:
@@ -17,10 +20,24 @@ class RandomTree:
                 raise ValueError("A labels should be given for every node of the tree!")
         else:
             self.labels = ["clone" + str(i) for i in range(self.n)]
-        self.clones =[Clone(idx=i, humanGenome=humanGenome, binsize=binsize, label=self.labels[i]) for i in range(self.n)]
+        genome = germline(humanGenome, binsize)
+        self.clones =[Clone(idx=i, humanGenome=humanGenome, binsize=binsize, label=self.labels[i], genome=genome) for i in range(self.n)]
         self.mapclone = {clone.idx : clone for clone in self.clones}
         self.root = None
-        self.buildRandom()
+        if children != None:
+            self.buildGiven(children)
+        elif topology == 'random':
+            self.buildRandom()
+        elif topology == 'coalescent':
+            self.buildCoalescent()
+        elif topology == 'birthdeath':
+            self.buildBirthDeath()
+        elif topology == 'linear':
+            self.buildLinear()
+        elif topology == 'star':
+            self.buildStar()
+        else:
+            raise ValueError("The tree topology {} is not supported!".format(topology))
         noparent = set(clone for clone in self.clones if clone.parent == None)
         assert(len(noparent) == 1)
         assert(self.root != None)
@@ -51,78 +68,143 @@ class RandomTree:
                 self.clones[0].children.append(self.clones[2])
                 self.clones[2].parent = self.clones[0]
         else:
-            self.sequence = [random.choice([clone.idx for clone in self.clones]) for i in range(self.n - 2)]
+            ids = [clone.idx for clone in self.clones]
+            self.sequence = [random.choice(ids) for i in range(self.n - 2)]
             #self.sequence.append(0)
             adj = {clone.idx : [] for clone in self.clones}
-            degrees = {idx : 1 + self.sequence.count(idx) for idx in [clone.idx for clone in self.clones]}
+            counts = Counter(self.sequence)
+            degrees = {idx : 1 + counts[idx] for idx in ids}
 
+            # The smallest leaf is attached at every step as the clones are ordered by index
+            leaves = [idx for idx in ids if degrees[idx] == 1]
+            heapq.heapify(leaves)
             for i in self.sequence:
-                for clone in self.clones:
-                    if degrees[clone.idx] == 1:
-                        adj[i].append(clone.idx)
-                        adj[clone.idx].append(i)
-                        degrees[i] -= 1
-                        degrees[clone.idx] -= 1
-                        break
+                leaf = heapq.heappop(leaves)
+                adj[i].append(leaf)
+                adj[leaf].append(i)
+                degrees[i] -= 1
+                degrees[leaf] -= 1
+                if degrees[i] == 1:
+                    heapq.heappush(leaves, i)
             assert(sum(degrees[idx] == 1 for idx in degrees) == 2)
 
-            u = -1
-            v = -1
-            for clone in self.clones:
-                if degrees[clone.idx] == 1:
-                    if u == -1:
-                        u = clone
-                    else:
-                        v = clone
-                        break
+            u, v = [self.mapclone[heapq.heappop(leaves)] for i in range(2)]
             adj[u.idx].append(v.idx)
             adj[v.idx].append(u.idx)
             degrees[u.idx] -= 1
             degrees[v.idx] -= 1
             assert(len(set(degrees[idx] == 0 for idx in range(self.n))) == 1)
 
-            def orient(clone, adj, placed, mapclone):
-                random.shuffle(adj[clone.idx])
-                for child in adj[clone.idx]:
-                    if not child in placed:
-                        clone.children.append(mapclone[child])
-                        mapclone[child].parent = clone
-                        placed.add(child)
-                        orient(mapclone[child], adj, placed, mapclone)
-
-            placed = set()
             #self.root = random.choice(self.clones)
             self.root = self.clones[0]
             assert(self.root != None)
             assert(self.root.parent == None)
-            placed.add(self.root.idx)
-            orient(self.root, adj, placed, self.mapclone)
+            self.orient(adj)
+
+    def orient(self, adj):
+        # Depth-first orientation from the root with an explicit stack, neighbours are shuffled when a clone is reached
+        placed = set([self.root.idx])
+        random.shuffle(adj[self.root.idx])
+        stack = [(self.root, iter(adj[self.root.idx]))]
+        while len(stack) > 0:
+            clone, neighbours = stack[-1]
+            child = next((idx for idx in neighbours if not idx in placed), None)
+            if child == None:
+                stack.pop()
+            else:
+                self.attach(clone, self.mapclone[child])
+                placed.add(child)
+                random.shuffle(adj[child])
+                stack.append((self.mapclone[child], iter(adj[child])))
+
+    def attach(self, parent, child):
+        parent.children.append(child)
+        child.parent = parent
+
+    def buildLinear(self):
+        self.root = self.clones[0]
+        for parent, child in zip(self.clones[:-1], self.clones[1:]):
+            self.attach(parent, child)
+
+    def buildStar(self):
+        self.root = self.clones[0]
+        for child in self.clones[1:]:
+            self.attach(self.root, child)
+
+    def buildCoalescent(self):
+        # Backwards in time, two random lineages coalesce at every step where the root clone of one lineage becomes the
+        # parent of the other; clones are then assigned in breadth-first order such that the founder is the first
+        parents = {}
+        lineages = range(self.n)
+        while len(lineages) > 1:
+            i, j = random.sample(xrange(len(lineages)), 2)
+            parents[lineages[j]] = lineages[i]
+            lineages[j] = lineages[-1]
+            lineages.pop()
+        self.relabel(lineages[0], parents)
+
+    def buildBirthDeath(self, deathratio=0.5):
+        # Forward in time, a random alive clone either gives birth to a new clone or dies with probability given by the
+        # ratio of death rate over birth rate, while the last alive clone never dies
+        self.root = self.clones[0]
+        alive = [self.root]
+        for child in self.clones[1:]:
+            while True:
+                k = int(random.random() * len(alive))
+                if len(alive) == 1 or random.random() >= deathratio / (1.0 + deathratio):
+                    break
+                alive[k] = alive[-1]
+                alive.pop()
+            self.attach(alive[k], child)
+            alive.append(child)
+
+    def buildGiven(self, children):
+        # The tree is given by the ordered indices of the children of every clone, such that the root is the only clone
+        # which is not a child
+        if len(children) != self.n:
+            raise ValueError("The children should be given for every node of the tree!")
+        for clone, idxs in zip(self.clones, children):
+            for idx in idxs:
+                self.attach(clone, self.mapclone[idx])
+        self.root = next((clone for clone in self.clones if clone.parent == None), None)
+
+    def relabel(self, root, parents):
+        children = {}
+        for node in sorted(parents):
+            children.setdefault(parents[node], []).append(node)
+        order = [root]
+        for node in order:
+            order.extend(children.get(node, []))
+        clone = {node : self.clones[i] for i, node in enumerate(order)}
+        self.root = clone[root]
+        for node in order[1:]:
+            self.attach(clone[parents[node]], clone[node])
 
 
 
     def draw(self):
         colors = ["red", "blue", "purple", "green", "brown", "cadetblue", "chartreuse","cyan", "pink", "Grey", "orange"]
 
-        s = "digraph EvolutionaryCloneTree {\n"
-        s += 'splines=true;\nsep="+25,25";\noverlap=scalexy;\nnodesep=0.6;\n'
+        s = ["digraph EvolutionaryCloneTree {\n"]
+        s.append('splines=true;\nsep="+25,25";\noverlap=scalexy;\nnodesep=0.6;\n')
 
-        s += "\tsubgraph T {\n"
+        s.append("\tsubgraph T {\n")
         rank = []
-        s += "\t\tN[label=<<B>Normal</B>>,color=black]\n"
+        s.append("\t\tN[label=<<B>Normal</B>>,color=black]\n")
         for clone in self.clones:
-            s += "\t\t{}[label=<<B>clone</B><SUB>{}</SUB>>,color={}]\n".format(clone.idx, clone.idx, colors[clone.idx%11])
+            s.append("\t\t{}[label=<<B>clone</B><SUB>{}</SUB>>,color={}]\n".format(clone.idx, clone.idx, colors[clone.idx%11]))
             if len(clone.children) == 0:
                 rank.append(clone.idx)
 
-        s += "\t{rank = same; "+ "; ".join(map(str, rank)) + "}\n"
-        s += "\t}\n"
+        s.append("\t{rank = same; "+ "; ".join(map(str, rank)) + "}\n")
+        s.append("\t}\n")
 
-        s += '\tN -> {} [label="{}", fontsize=5, fixedsize=true]\n'.format(self.root.idx, "\n".join(self.root.mutationLabels))
+        s.append('\tN -> {} [label="{}", fontsize=5, fixedsize=true]\n'.format(self.root.idx, "\n".join(self.root.mutationLabels)))
         for clone in self.clones:
             for child in clone.children:
-                s += '\t{} -> {} [label="{}", fontsize=5, fixedsize=true]\n'.format(clone.idx, child.idx, "\n".join(child.mutationLabels))
+                s.append('\t{} -> {} [label="{}", fontsize=5, fixedsize=true]\n'.format(clone.idx, child.idx, "\n".join(child.mutationLabels)))
 
-        s += "}\n"
+        s.append("}\n")
 
-        return s
+        return ''.join(s)
         #proc = subprocess.call("dot -Tpdf " + dotfile + " -o " + outname,shell=True)
@@ -0,0 +1,513 @@
+import os
+import re
+import sys
+import mmap
+import zlib
+import struct
+import shutil
+import tempfile
+from array import array
+from bisect import bisect_right
+from binascii import hexlify, unhexlify
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+
+import Support
+
+
+# Size of the blocks of bases that are read and processed at once
+BLOCKSIZE = 1 << 22
+
+
+class FastaReader:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.names = []
+        self.index = {}
+        fai = filename + '.fai'
+        if os.path.isfile(fai) and os.path.getmtime(fai) >= os.path.getmtime(filename):
+            self.readIndex(fai)
+        else:
+            self.buildIndex()
+            try:
+                self.writeIndex(fai)
+            except (IOError, OSError):
+                Support.log(msg='The FASTA index cannot be written in {}, the index is kept in memory\n'.format(fai), level='WARN')
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def length(self, name):
+        return self.index[name][0]
+
+    def readIndex(self, fai):
+        with open(fai, 'r') as f:
+            for line in f:
+                if line.strip() != '':
+                    name, length, offset, linebases, linewidth = line.strip().split('\t')[:5]
+                    self.names.append(name)
+                    self.index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+
+    def buildIndex(self):
+        name = None
+        offset = 0
+        with open(self.filename, 'r') as f:
+            for line in f:
+                if line[0] == '>':
+                    name = line.strip()[1:].split()[0]
+                    if name in self.index:
+                        raise ValueError(Support.error('The contig {} is repeated in the FASTA file {}!'.format(name, self.filename)))
+                    self.names.append(name)
+                    self.index[name] = [0, offset + len(line), 0, 0, False]
+                elif name != None:
+                    record = self.index[name]
+                    bases = len(line.rstrip('\r\n'))
+                    if record[4] or (record[2] > 0 and bases > record[2]):
+                        raise ValueError(Support.error('The FASTA file {} has lines of different lengths in {} and cannot be indexed!'.format(self.filename, name)))
+                    if record[2] == 0:
+                        record[2] = bases
+                        record[3] = len(line)
+                    elif bases < record[2]:
+                        # Only the last line of a contig can be shorter
+                        record[4] = True
+                    record[0] += bases
+                offset += len(line)
+        self.index = {name : tuple(self.index[name][:4]) for name in self.index}
+
+    def writeIndex(self, fai):
+        with open(fai, 'w') as f:
+            f.writelines('{}\t{}\t{}\t{}\t{}\n'.format(name, *self.index[name]) for name in self.names)
+
+    def __getstate__(self):
+        # The memory map is not shared through pickling but re-opened by every process
+        state = dict(self.__dict__)
+        state['map'] = None
+        return state
+
+    def memorymap(self):
+        if getattr(self, 'map', None) == None:
+            with open(self.filename, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def view(self, name, start=0, end=None):
+        # Read-only view of the bases in [start, end), which does not copy any data when these are in a single line
+        length, offset, linebases, linewidth = self.index[name]
+        end = length if end == None else min(end, length)
+        if start >= end:
+            return ''
+        first = offset + (start // linebases) * linewidth + start % linebases
+        last = offset + ((end - 1) // linebases) * linewidth + (end - 1) % linebases + 1
+        if last - first == end - start:
+            return buffer(self.memorymap(), first, last - first)
+        else:
+            return self.memorymap()[first:last].translate(None, '\r\n')
+
+    def fetch(self, name, start=0, end=None):
+        return bytearray(self.view(name, start, end))
+
+
+def reader(filename):
+    # Sequences are read through the same interface from indexed FASTA files or 2bit files
+    if filename.endswith('.2bit'):
+        return TwoBitReader(filename)
+    return FastaReader(filename)
+
+
+class TwoBitReader(FastaReader):
+
+    BASES = [''.join(['TCAG'[(byte >> shift) & 3] for shift in (6, 4, 2, 0)]) for byte in range(256)]
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.names = []
+        self.index = {}
+        data = self.memorymap()
+        signature, version, count = struct.unpack('<3I', data[:12])
+        if signature != TwoBitWriter.SIGNATURE or version not in (0, 1):
+            raise ValueError(Support.error('The file {} is not a supported 2bit file!'.format(filename)))
+        pos = 16
+        for i in xrange(count):
+            size = ord(data[pos])
+            name = data[pos + 1:pos + 1 + size]
+            pos += 1 + size
+            if version == 0:
+                offset = struct.unpack('<I', data[pos:pos + 4])[0]
+                pos += 4
+            else:
+                offset = struct.unpack('<Q', data[pos:pos + 8])[0]
+                pos += 8
+            self.names.append(name)
+            length = struct.unpack('<I', data[offset:offset + 4])[0]
+            offset, nblocks = self.readBlocks(data, offset + 4)
+            offset, mblocks = self.readBlocks(data, offset)
+            self.index[name] = (length, offset + 4, nblocks, mblocks)
+
+    def readBlocks(self, data, offset):
+        # Blocks are kept as sorted start and end positions to find the blocks overlapping an interval by bisection
+        count = struct.unpack('<I', data[offset:offset + 4])[0]
+        starts = struct.unpack('<{}I'.format(count), data[offset + 4:offset + 4 + 4 * count])
+        sizes = struct.unpack('<{}I'.format(count), data[offset + 4 + 4 * count:offset + 4 + 8 * count])
+        return offset + 4 + 8 * count, (array('l', starts), array('l', (s + l for s, l in izip(starts, sizes))))
+
+    def view(self, name, start=0, end=None):
+        length, offset, nblocks, mblocks = self.index[name]
+        end = length if end == None else min(end, length)
+        if start >= end:
+            return ''
+        first, last = start // 4, (end + 3) // 4
+        packed = bytearray(self.memorymap()[offset + first:offset + last])
+        sequence = bytearray(''.join(map(TwoBitReader.BASES.__getitem__, packed))[start - 4 * first:end - 4 * first])
+        for s, e in overlaps(nblocks, start, end):
+            sequence[s - start:e - start] = 'N' * (e - s)
+        for s, e in overlaps(mblocks, start, end):
+            sequence[s - start:e - start] = sequence[s - start:e - start].lower()
+        return sequence
+
+
+def overlaps(blocks, start, end):
+    starts, ends = blocks
+    for i in xrange(bisect_right(ends, start), len(starts)):
+        if starts[i] >= end:
+            break
+        yield max(starts[i], start), min(ends[i], end)
+
+
+def writer(filename, width=60, index=True, compress=False, threads=1, twobit=False, offset=None):
+    if twobit:
+        return TwoBitWriter(filename)
+    return FastaWriter(filename, width=width, index=index, compress=compress, threads=threads, offset=offset)
+
+
+def bodysize(length, width=60):
+    # Size of a wrapped sequence including all new lines
+    if width <= 0:
+        return length + 1
+    return length + (length + width - 1) // width
+
+
+def allocate(filename, records, width=60):
+    # Reserve an uncompressed FASTA file with its .fai index for the given records (name, length), such that the
+    # records can be written in any order and in parallel at the returned offsets
+    offsets = []
+    offset = 0
+    with open(filename + '.fai', 'w') as f:
+        for name, length in records:
+            offsets.append(offset)
+            offset += len('>{}\n'.format(name))
+            linebases = width if width > 0 else length
+            f.write('{}\t{}\t{}\t{}\t{}\n'.format(name, length, offset, linebases, linebases + 1))
+            offset += bodysize(length, width)
+    with open(filename, 'wb') as out:
+        out.truncate(offset)
+    return offsets
+
+
+class FastaWriter:
+
+    def __init__(self, filename, width=60, index=True, compress=False, threads=1, offset=None):
+        self.filename = filename
+        self.width = width
+        self.index = index
+        if offset != None:
+            # Records are written at the given offset of an existing file, e.g. reserved by allocate()
+            assert(not compress)
+            self.out = open(filename, 'r+b')
+            self.out.seek(offset)
+        else:
+            self.out = BgzfWriter(filename, threads=threads) if compress else open(filename, 'wb')
+        self.offset = offset if offset != None else 0
+        self.records = []
+        self.name = None
+        self.start_offset = 0
+        self.length = 0
+        self.column = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, name, sequence):
+        self.start(name)
+        self.append(sequence)
+        return self.end()
+
+    def start(self, name):
+        # A record without name only writes the wrapped sequence, which can be later copied into a FASTA file
+        if name != None:
+            header = '>{}\n'.format(name)
+            self.out.write(header)
+            self.offset += len(header)
+        self.name = name
+        self.start_offset = self.offset
+        self.length = 0
+        self.column = 0
+
+    def append(self, sequence):
+        data = buffer(sequence)
+        size = len(data)
+        self.length += size
+        if self.width <= 0:
+            self.out.write(data)
+            return
+        pos = 0
+        if self.column > 0:
+            pos = min(self.width - self.column, size)
+            self.out.write(data[:pos])
+            self.column += pos
+            if self.column == self.width:
+                self.out.write('\n')
+                self.column = 0
+        lines = (size - pos) // self.width
+        while lines > 0:
+            # Full lines are joined in large blocks to limit the number of writes
+            block = min(lines, 1 << 16)
+            self.out.write('\n'.join([data[p:p + self.width] for p in xrange(pos, pos + block * self.width, self.width)]))
+            self.out.write('\n')
+            pos += block * self.width
+            lines -= block
+        if pos < size:
+            self.out.write(data[pos:])
+            self.column = size - pos
+
+    def end(self):
+        if self.width <= 0 or self.column > 0:
+            self.out.write('\n')
+        self.offset = self.start_offset + self.bodysize(self.length)
+        if self.name != None:
+            self.records.append((self.name, self.length, self.start_offset))
+        self.name = None
+        return self.length
+
+    def copy(self, name, part, length, offset=None):
+        # Copy the sequence of a record written without name by a writer with the same width, or the wrapped sequence
+        # of a record at the given offset of another FASTA file
+        self.start(name)
+        with open(part, 'rb') as f:
+            if offset == None:
+                shutil.copyfileobj(f, self.out, 1 << 24)
+            else:
+                f.seek(offset)
+                size = self.bodysize(length)
+                while size > 0:
+                    block = f.read(min(size, 1 << 24))
+                    self.out.write(block)
+                    size -= len(block)
+        self.length = length
+        self.column = 0
+        self.offset = self.start_offset + self.bodysize(length)
+        self.records.append((name, length, self.start_offset))
+        self.name = None
+
+    def bodysize(self, length):
+        return bodysize(length, self.width)
+
+    def close(self):
+        self.out.close()
+        if self.index:
+            with open(self.filename + '.fai', 'w') as f:
+                for name, length, offset in self.records:
+                    linebases = self.width if self.width > 0 else length
+                    f.write('{}\t{}\t{}\t{}\t{}\n'.format(name, length, offset, linebases, linebases + 1))
+
+
+def concatenate(outputs, width=60, compress=False, threads=1, twobit=False):
+    # Copy the parts given as (name, part, length) for every output in order, such that e.g. both haplotypes are joined
+    # in a diploid FASTA file in a single pass
+    for output, records in outputs:
+        with writer(output, width=width, compress=compress, threads=threads, twobit=twobit) as out:
+            for name, part, length in records:
+                out.copy(name, part, length)
+
+
+class TwoBitWriter:
+
+    # Bases are packed in 2 bits as T=0, C=1, A=2, G=3 where any other base is stored as a block of Ns
+    SIGNATURE = 0x1A412743
+    CODES = ''.join(chr({'T' : 0, 'C' : 1, 'A' : 2, 'G' : 3}.get(chr(c).upper(), 0)) for c in range(256))
+    # Appended sequences are packed in chunks of bases, a multiple of 4, to bound the memory
+    CHUNK = 1 << 20
+    NBLOCKS = re.compile('[^ACGTacgt]+')
+    MBLOCKS = re.compile('[a-z]+')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = []
+        self.name = None
+        self.part = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, name, sequence):
+        self.start(name)
+        self.append(sequence)
+        return self.end()
+
+    def start(self, name):
+        # A record without name is written as a part, which can be later copied into a 2bit file, while records with
+        # a name are first written in temporary parts since the index precedes all records
+        self.name = name
+        self.part = self.filename if name == None else '{}.{}.tmp'.format(self.filename, len(self.records))
+        self.body = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.filename)))
+        self.length = 0
+        self.pending = ''
+        self.nblocks = (array('l'), array('l'))
+        self.mblocks = (array('l'), array('l'))
+
+    def append(self, sequence):
+        view = buffer(sequence)
+        for left in xrange(0, len(view), TwoBitWriter.CHUNK):
+            self.appendChunk(view[left:left + TwoBitWriter.CHUNK])
+
+    def appendChunk(self, data):
+        # Blocks are only searched in chunks containing bases other than ACGT or lower-case bases
+        blocks = []
+        if len(data.translate(None, 'ACGTacgt')) > 0:
+            blocks.append((TwoBitWriter.NBLOCKS, self.nblocks))
+        if data.upper() != data:
+            blocks.append((TwoBitWriter.MBLOCKS, self.mblocks))
+        for pattern, (starts, sizes) in blocks:
+            for match in pattern.finditer(data):
+                start, end = self.length + match.start(), self.length + match.end()
+                # Blocks spanning consecutive appends are merged
+                if len(starts) > 0 and starts[-1] + sizes[-1] == start:
+                    sizes[-1] += end - start
+                else:
+                    starts.append(start)
+                    sizes.append(end - start)
+        self.length += len(data)
+        codes = self.pending + data.translate(TwoBitWriter.CODES)
+        full = len(codes) - len(codes) % 4
+        if full > 0:
+            self.body.write(pack(codes[:full]))
+        self.pending = codes[full:]
+
+    def end(self):
+        if len(self.pending) > 0:
+            self.body.write(pack(self.pending.ljust(4, '\x00')))
+        if self.length > 0xffffffff:
+            raise ValueError(Support.error('The sequence {} is too long for the 2bit format!'.format(self.name)))
+        with open(self.part, 'wb') as out:
+            out.write(struct.pack('<2I', self.length, len(self.nblocks[0])))
+            out.write(uint32(self.nblocks[0]) + uint32(self.nblocks[1]))
+            out.write(struct.pack('<I', len(self.mblocks[0])))
+            out.write(uint32(self.mblocks[0]) + uint32(self.mblocks[1]))
+            out.write(struct.pack('<I', 0))
+            self.body.seek(0)
+            shutil.copyfileobj(self.body, out, 1 << 24)
+        self.body.close()
+        if self.name != None:
+            self.records.append((self.name, self.part, True))
+        self.name = None
+        return self.length
+
+    def copy(self, name, part, length):
+        # Copy a record written without name, the copy is delayed until all records are known
+        self.records.append((name, part, False))
+
+    def close(self):
+        if len(self.records) == 0 and self.part == self.filename:
+            return
+        sizes = [os.path.getsize(part) for name, part, temporary in self.records]
+        indexsize = 16 + sum(1 + len(name) for name, part, temporary in self.records)
+        # Offsets of 64 bits are used when the file exceeds 4Gb as in version 1 of the format
+        version = 0 if indexsize + 4 * len(self.records) + sum(sizes) <= 0xffffffff else 1
+        offset = indexsize + (4 if version == 0 else 8) * len(self.records)
+        with open(self.filename, 'wb') as out:
+            out.write(struct.pack('<4I', TwoBitWriter.SIGNATURE, version, len(self.records), 0))
+            for (name, part, temporary), size in zip(self.records, sizes):
+                out.write(struct.pack('<B', len(name)) + name + struct.pack('<I' if version == 0 else '<Q', offset))
+                offset += size
+            for name, part, temporary in self.records:
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, out, 1 << 24)
+                if temporary:
+                    os.remove(part)
+
+
+def uint32(values):
+    # Little-endian unsigned integers of 32 bits packed from an array without going through Python integers
+    values = array('I', values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tostring()
+
+
+def pack(codes):
+    # Every group of 4 bytes holding the codes (c0, c1, c2, c3) of 4 bases is packed into the byte c0c1c2c3 by shifting
+    # the whole chunk as a single integer, such that the last byte of every group of 4 bytes is the packed one
+    value = long(hexlify(codes), 16)
+    value |= value >> 6
+    value |= value >> 12
+    return unhexlify('%0*x' % (2 * len(codes), value))[3::4]
+
+
+class BgzfWriter:
+
+    # Blocks hold at most 0xff00 bytes of input as in htslib such that compressed blocks never exceed 64kb
+    BLOCKSIZE = 0xff00
+    HEADER = struct.Struct('<4BI2BH2BHH')
+    FOOTER = struct.Struct('<2I')
+    EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+    def __init__(self, filename, threads=1, level=6):
+        self.filename = filename
+        self.level = level
+        self.out = open(filename, 'wb')
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        self.batch = BgzfWriter.BLOCKSIZE * 64 * max(1, threads)
+        self.buffer = bytearray()
+        self.compressed = 0
+        self.uncompressed = 0
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.batch:
+            self.flush(final=False)
+
+    def block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        header = BgzfWriter.HEADER.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+        return header + cdata + BgzfWriter.FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+
+    def flush(self, final=True):
+        # Only full blocks are compressed until the file is closed, blocks are compressed in parallel by threads as zlib
+        # releases the interpreter lock
+        size = len(self.buffer) if final else (len(self.buffer) // BgzfWriter.BLOCKSIZE) * BgzfWriter.BLOCKSIZE
+        chunks = [buffer(self.buffer, p, min(BgzfWriter.BLOCKSIZE, size - p)) for p in xrange(0, size, BgzfWriter.BLOCKSIZE)]
+        blocks = self.pool.map(self.block, chunks) if self.pool != None else map(self.block, chunks)
+        for chunk, block in zip(chunks, blocks):
+            if self.compressed > 0:
+                self.blocks.append((self.compressed, self.uncompressed))
+            self.out.write(block)
+            self.compressed += len(block)
+            self.uncompressed += len(chunk)
+        del self.buffer[:size]
+
+    def close(self):
+        self.flush(final=True)
+        self.out.write(BgzfWriter.EOF)
+        self.out.close()
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+        # The .gzi index lists the compressed and uncompressed offsets of all blocks but the first
+        with open(self.filename + '.gzi', 'wb') as f:
+            f.write(struct.pack('<Q', len(self.blocks)))
+            for entry in self.blocks:
+                f.write(struct.pack('<2Q', *entry))
@@ -1,21 +1,31 @@
 import os
-import math
+import sys
 import copy
+import struct
 import random
-from collections import Counter
+from array import array
+from bisect import bisect_left, bisect_right
+from binascii import hexlify, unhexlify
+from operator import itemgetter
+from itertools import izip, compress, permutations
+from multiprocessing import Pool
 
 import Support
+import Formats
 
 
 
 class HumanGenome:
 
-    def __init__(self, reference, snplist, snpratio, HEHOratio, ignorelist):
+    def __init__(self, reference, snplist, snpratio, HEHOratio, ignorelist, regions=None):
         self.reference = reference
+        self.reader = Formats.reader(reference)
         self.snplist = Support.parseSNPList(snplist)
         self.snpratio = snpratio
         self.HEHOratio = HEHOratio
         self.ignorelist = ignorelist
+        self.regions = regions
+        self.contigs = {}
         self.chromosomes = []
         self.lengths = {}
         self.maternalfa = None
@@ -23,83 +33,216 @@ class HumanGenome:
         self.numsnps = 0
         self.hetsnps = 0
         self.phases = {}
+        self.snps = {}
 
-    def buildGenome(self, maternalout, paternalout):
+    def buildGenome(self, maternalout, paternalout, jobs=1, seed=None, width=60, compress=False, suffixes=('', ''), twobit=False):
+        if maternalout == paternalout and suffixes[0] == suffixes[1]:
+            raise ValueError(Support.error('Different haplotype suffixes are required to write a diploid FASTA file!'))
         self.maternalfa = maternalout
         self.paternalfa = paternalout
-        with open(self.maternalfa, 'w') as mafa:
-            with open(self.paternalfa, 'w') as pafa:
-                name = ''
-                sequence = []
-                with open(self.reference, 'r') as ref:
-                    for line in ref:
-                        if line != '':
-                            if line[0] == '>':
-                                if name != '' and not name in self.ignorelist:
-                                    mafa.write(">{}\n".format(name))
-                                    pafa.write(">{}\n".format(name))
-                                    maternalhap, paternalhap, length = self.buildHaplotypes(chromosome=name, sequence=sequence)
-                                    mafa.write("{}\n".format(''.join(maternalhap)))
-                                    pafa.write("{}\n".format(''.join(paternalhap)))
-                                    self.chromosomes.append(name)
-                                    self.lengths[name] = length
-                                name = line.strip()[1:].split()[0]
-                                sequence = []
-                            else:
-                                if not name is self.ignorelist:
-                                    sequence += list(line.strip())
-                    if len(sequence) > 0:
-                        if name != '' and not name in self.ignorelist:
-                            mafa.write(">{}\n".format(name))
-                            pafa.write(">{}\n".format(name))
-                            maternalhap, paternalhap, length = self.buildHaplotypes(chromosome=name, sequence=sequence)
-                            mafa.write("{}\n".format(''.join(maternalhap)))
-                            pafa.write("{}\n".format(''.join(paternalhap)))
-                            self.chromosomes.append(name)
-                            self.lengths[name] = length
-
-        with open(os.path.join(os.path.dirname(self.maternalfa), 'phases.tsv'), 'w') as o:
-            for g in sorted(self.phases.keys(), key=(lambda x : (int(''.join([l for l in x[0] if l.isdigit()])), x[1]))):
-                o.write('{}\t{}\t{}\n'.format(g[0], g[1], self.phases[g]))
+        if seed == None:
+            seed = random.getrandbits(64)
 
+        # Only the selected contigs or intervals are fetched from the reference through its index
+        if self.regions == None:
+            regions = [(name, None, None) for name in self.reader.names if not name in self.ignorelist]
+        else:
+            regions = self.regions
+        labels = []
+        for name, start, end in regions:
+            if not name in self.reader:
+                raise ValueError(Support.error('The contig {} is not present in the reference genome!'.format(name)))
+            length = self.reader.length(name)
+            if start == None:
+                label = name
+                start, end = 0, length
+            else:
+                end = min(end, length)
+                if start >= end:
+                    raise ValueError(Support.error('The region {}:{}-{} is empty or outside the contig!'.format(name, start + 1, end)))
+                label = '{}:{}-{}'.format(name, start + 1, end)
+            if label in self.contigs:
+                raise ValueError(Support.error('The region {} is given more than once!'.format(label)))
+            self.contigs[label] = (name, start, end)
+            labels.append(label)
+        if len(labels) == 0:
+            raise ValueError(Support.error('No contig of the reference genome is left to simulate after ignoring the given ones!'))
+
+        # Every chromosome is simulated independently with its own random stream, written in a separate part,
+        # and the parts are concatenated in reference order such that results do not depend on the number of jobs
+        tasks = [(self.reference, label, self.contigs[label], self.listedSNPs(label), self.snpratio, self.HEHOratio, seed, width, twobit, '{}.m{}.part'.format(maternalout, i), '{}.p{}.part'.format(paternalout, i)) for i, label in enumerate(labels)]
+        if jobs == 1:
+            results = map(buildChromosome, tasks)
+        else:
+            pool = Pool(processes=min(jobs, len(tasks)))
+            results = pool.map(buildChromosome, tasks, chunksize=1)
+            pool.close()
+            pool.join()
+
+        for name, length, snps, phases in results:
+            self.chromosomes.append(name)
+            self.lengths[name] = length
+            self.snps[name] = snps
+            self.phases[name] = phases
+            self.numsnps += len(snps[0])
+            self.hetsnps += len(phases[0])
+
+        # Both haplotypes are written in a single diploid FASTA file when the two outputs are the same
+        maternal = [(label + suffixes[0], task[9], self.lengths[label]) for label, task in zip(labels, tasks)]
+        paternal = [(label + suffixes[1], task[10], self.lengths[label]) for label, task in zip(labels, tasks)]
+        outputs = [(maternalout, maternal + paternal)] if maternalout == paternalout else [(maternalout, maternal), (paternalout, paternal)]
+        Formats.concatenate(outputs, width=width, compress=compress, threads=jobs, twobit=twobit)
+        for name, part, length in maternal + paternal:
+            os.remove(part)
 
-    def buildHaplotypes(self, chromosome, sequence):
-        mhap = copy.deepcopy(sequence)# if s != 'N' and s != 'n' and s != '*']
-        phap = copy.deepcopy(sequence)
-        lenchr = len(mhap)
+        with open(os.path.join(os.path.dirname(self.maternalfa), 'phases.tsv'), 'w') as o:
+            order = (lambda x : (int(''.join([l for l in x.split(':')[0] if l.isdigit()]) or sys.maxint), self.contigs[x]))
+            for chro in sorted(self.phases.keys(), key=order):
+                positions, bits = self.phases[chro]
+                o.writelines('{}\t{}\t{}\n'.format(chro, pos, '1|0' if bit == 49 else '0|1') for pos, bit in izip(positions, bits))
+
+    def listedSNPs(self, chromosome):
+        # SNPs of the given list within the region of the chromosome, with 1-based positions relative to its start, or
+        # None when the SNPs are placed randomly
         if self.snplist == None:
-            assert(0 <= self.snpratio <= 1.0)
-            snplist = {snp : set(random.sample(['A','T','C','G'], 2)) for snp in random.sample(xrange(len(mhap)), int(round(len(mhap) * self.snpratio)))}
-        else:
-            snplist = self.snplist[chromosome]
-
-        for snp in snplist:
-            if snp < lenchr:
-                self.numsnps += 1
-                if random.random() < self.HEHOratio:
-                    # Heterozygous SNP
-                    alleles = snplist[snp]
-                    if random.random() < 0.5:
-                        mhap[snp - 1] = alleles[0].lower() if mhap[snp].islower() else alleles[0].upper()
-                        phap[snp - 1] = alleles[1].lower() if phap[snp].islower() else alleles[1].upper()
-                        self.phases[(chromosome, snp)] = '0|1'
-                    else:
-                        mhap[snp - 1] = alleles[1].lower() if mhap[snp].islower() else alleles[1].upper()
-                        phap[snp - 1] = alleles[0].lower() if phap[snp].islower() else alleles[0].upper()
-                        self.phases[(chromosome, snp)] = '1|0'
-                    self.hetsnps += 1
-                else:
-                    # Homozygous SNP
-                    allele = snplist[snp][0]
-                    mhap[snp - 1] = allele.lower() if mhap[snp].islower() else allele.upper()
-                    phap[snp - 1] = allele.lower() if phap[snp].islower() else allele.upper()
-
-        return mhap, phap, lenchr
+            return None
+        name, start, end = self.contigs[chromosome]
+        if not name in self.snplist:
+            return array('i'), bytearray()
+        positions, alleles = self.snplist[name]
+        first, last = bisect_right(positions, start), bisect_right(positions, end)
+        positions = array('i', (pos - start for pos in positions[first:last])) if start > 0 else positions[first:last]
+        return positions, alleles[first:last]
+
+    def materialize(self, chromosome, allele, start, end, blocksize=Formats.BLOCKSIZE):
+        # Stream the haplotype bases in [start, end) in blocks directly from the memory-mapped reference, only blocks
+        # containing SNPs are copied to apply the alleles of the haplotype
+        name, offset, stop = self.contigs[chromosome]
+        positions, maternal, paternal = self.snps[chromosome]
+        alleles = maternal if allele.lower() == 'm' else paternal
+        for left in xrange(start, end, blocksize):
+            right = min(left + blocksize, end)
+            block = self.reader.view(name, offset + left, offset + right)
+            first, last = bisect_left(positions, left), bisect_left(positions, right)
+            if first < last:
+                block = applySNPs(bytearray(block), positions[first:last], alleles[first:last], offset=left)
+            yield block
+
+
+def buildChromosome(task):
+    # Tasks only carry the region and the SNPs of their chromosome, while the reference is opened by every task
+    reference, name, contig, listed, snpratio, HEHOratio, seed, width, twobit, maternalpart, paternalpart = task
+    sequence = Formats.reader(reference).fetch(*contig)
+    snps, phases = buildHaplotypes(sequence=sequence, snps=listed, snpratio=snpratio, HEHOratio=HEHOratio, rng=Support.rngstream(seed, name))
+    with Formats.writer(maternalpart, width=width, index=False, twobit=twobit) as out:
+        out.write(None, applySNPs(sequence, snps[0], snps[1]))
+    with Formats.writer(paternalpart, width=width, index=False, twobit=twobit) as out:
+        out.write(None, applySNPs(sequence, snps[0], snps[2]))
+    return name, len(sequence), snps, phases
+
+
+def buildHaplotypes(sequence, snps, snpratio, HEHOratio, rng=random):
+    # The two haplotypes are represented by the shared reference plus the sorted positions of the SNPs and the
+    # corresponding maternal and paternal alleles, which are materialized on demand by haplotype()
+    lenchr = len(sequence)
+    if snps == None:
+        assert(0 <= snpratio <= 1.0)
+        positions = sorted(rng.sample(xrange(1, lenchr + 1), int(round(lenchr * snpratio))))
+        pairs = list(permutations('ACGT', 2))
+        alleles = [pairs[(word * len(pairs)) >> 32] for word in randomwords(len(positions), rng)]
+        first = ''.join(a[0] for a in alleles)
+        second = ''.join(a[1] for a in alleles)
+    else:
+        positions, alleles = snps
+        first = str(alleles.translate(Support.SNPList.FIRST))
+        second = str(alleles.translate(Support.SNPList.SECOND))
+
+    # Zygosity and phase of all the SNPs in the chromosome are drawn in batch, where a SNP is heterozygous when its
+    # random word is below the given ratio of all words and a phase bit 0 stands for 0|1
+    numsnps = len(positions)
+    threshold = HEHOratio * (1 << 32)
+    het = [word < threshold for word in randomwords(numsnps, rng)]
+    bits = bin(rng.getrandbits(numsnps))[2:].zfill(numsnps) if numsnps > 0 else ''
+
+    maternal = ''.join(b if h and f == '1' else a for a, b, h, f in izip(first, second, het, bits))
+    paternal = ''.join(b if h and f == '0' else a for a, b, h, f in izip(first, second, het, bits))
+    snps = (array('l', (snp - 1 for snp in positions)), bytearray(maternal), bytearray(paternal))
+    phases = (array('l', compress(positions, het)), bytearray(compress(bits, het)))
+    return snps, phases
+
+
+def randomwords(count, rng=random):
+    # Uniform 32-bit words taken from a single draw of random bits
+    if count == 0:
+        return ()
+    return struct.unpack('>{}I'.format(count), unhexlify('%0*x' % (8 * count, rng.getrandbits(32 * count))))
+
+
+# Case bit of every soft-masked base
+SOFTMASK = ''.join([chr(32) if 97 <= code <= 122 else chr(0) for code in xrange(256)])
+
+
+def applySNPs(sequence, positions, alleles, offset=0):
+    # The replaced bases at the positions, relative to the given offset, are gathered at once such that soft-masked
+    # bases of the reference stay lower case by setting the case bits of all the alleles in a single operation
+    if len(positions) == 0:
+        return sequence
+    if offset != 0:
+        positions = map(offset.__rsub__, positions)
+    replaced = bytearray(itemgetter(*positions)(sequence)) if len(positions) > 1 else bytearray([sequence[positions[0]]])
+    masked = long(hexlify(alleles), 16) | long(hexlify(replaced.translate(SOFTMASK)), 16)
+    map(sequence.__setitem__, positions, bytearray(unhexlify('%0*x' % (2 * len(alleles), masked))))
+    return sequence
+
+
+class ActiveAlleles:
+
+    def __init__(self, genome):
+        # Index of the haplotypes of a clone with their lengths, where lost haplotypes are kept with length 0, such that
+        # targets of mutations are drawn in O(log n)
+        self.slots = [(c, 'm') for c in genome] + [(c, 'p') for c in genome]
+        self.position = {slot : i for i, slot in enumerate(self.slots)}
+        lengths = [genome[c].maternalHaplotypeLength for c in genome] + [genome[c].paternalHaplotypeLength for c in genome]
+        self.lengths = Support.FenwickTree(lengths)
+        self.counts = Support.FenwickTree(1 if l > 0 else 0 for l in lengths)
+
+    def __len__(self):
+        return self.counts.total
+
+    def copy(self):
+        # The slots and their positions are never modified and are shared by the copies
+        other = copy.copy(self)
+        other.lengths = self.lengths.copy()
+        other.counts = self.counts.copy()
+        return other
+
+    def update(self, chromosome, allele, length):
+        i = self.position[chromosome, allele]
+        self.lengths.update(i, length)
+        self.counts.update(i, 1 if length > 0 else 0)
+
+    def choice(self, rng=random):
+        # Uniform choice among the active haplotypes drawing the same random numbers as random.choice
+        return self.slots[self.counts.search(int(rng.random() * self.counts.total) + 1)]
+
+    def wchoice(self, rng=random):
+        # Choice weighted by the haplotype lengths with the same distribution and random numbers of the previous
+        # cumulative walk, which picks the first haplotype whose cumulative length is at least pick - 1
+        pick = rng.randint(1, int(self.lengths.total))
+        return self.slots[self.lengths.search(max(pick - 1, 1))]
+
+
+def germline(humanGenome, binsize):
+    # Chromosomes are divided in bins of the given size, or are represented by intervals with exact breakpoints when no
+    # bin size is given
+    if binsize == None:
+        return {c : IntervalChromosome(name=c, length=humanGenome.lengths[c]) for c in humanGenome.chromosomes}
+    return {c : Chromosome(name=c, length=humanGenome.lengths[c], binsize=binsize) for c in humanGenome.chromosomes}
 
 
 class Clone:
 
-    def __init__(self, idx, humanGenome, binsize, label=None):
+    def __init__(self, idx, humanGenome, binsize, label=None, genome=None):
         self.idx = idx
         if label == None:
             self.label = str(idx)
@@ -108,105 +251,105 @@ class Clone:
         assert(humanGenome.maternalfa != None and humanGenome.paternalfa != None)
         self.humanGenome = humanGenome
         self.chromosomes = humanGenome.chromosomes
-        self.genome = {c : Chromosome(name=c, length=humanGenome.lengths[c], binsize=binsize) for c in self.chromosomes}
+        # Chromosomes are shared copy-on-write with other clones, e.g. the given genome, and only the owned ones can be
+        # mutated in place
+        if genome == None:
+            self.genome = germline(humanGenome, binsize)
+            self.owned = set(self.chromosomes)
+        else:
+            self.genome = dict(genome)
+            self.owned = set()
+        # The index of the active haplotypes is built when first needed and is shared copy-on-write as the chromosomes
+        self.actives = None
+        self.ownsactives = False
         self.parent = None
         self.children = []
         self.mutationLabels = []
+        # Log of the mutation events as (type, chromosome, allele, start, size) such that the genome can be rebuilt by
+        # replaying them on the genome of the parent
+        self.events = []
 
     def inherit(self, parent):
         assert(isinstance(parent, Clone))
         assert(self.humanGenome is parent.humanGenome)
-        self.genome = {copy.deepcopy(c) : copy.deepcopy(parent.genome[c]) for c in parent.genome}
+        self.genome = dict(parent.genome)
+        self.owned = set()
+        parent.owned = set()
+        self.actives = parent.actives
+        self.ownsactives = False
+        parent.ownsactives = False
+
+    def alleles(self):
+        if self.actives == None:
+            self.actives = ActiveAlleles(self.genome)
+            self.ownsactives = True
+        elif not self.ownsactives:
+            self.actives = self.actives.copy()
+            self.ownsactives = True
+        return self.actives
+
+    def writable(self, chromosome):
+        if not chromosome in self.owned:
+            self.genome[chromosome] = self.genome[chromosome].copy()
+            self.owned.add(chromosome)
+        return self.genome[chromosome]
 
     def genomeLength(self):
         return sum(self.genome[c].maternalHaplotypeLength + self.genome[c].paternalHaplotypeLength for c in self.genome)
 
     def reference(self):
-        return {chro : copy.deepcopy(self.genome[chro].reference) for chro in self.chromosomes}
-
-    def copyNumberProfile(self):
-        return {chro : {'m' : dict(Counter(self.genome[chro].maternalHaplotype)), 'p' : dict(Counter(self.genome[chro].paternalHaplotype))} for chro in self.chromosomes}
+        # References are never mutated and are shared by all clones
+        return {chro : self.genome[chro].reference for chro in self.chromosomes}
 
     def wgd(self):
         for c in self.genome:
             if self.genome[c].maternalHaplotypeLength > 0:
-                self.genome[c].tandemDuplicate(start=0, size=self.genome[c].maternalHaplotypeLength, allele='m')
+                self.writable(c).tandemDuplicate(start=0, size=self.genome[c].maternalHaplotypeLength, allele='m')
             if self.genome[c].paternalHaplotypeLength > 0:
-                self.genome[c].tandemDuplicate(start=0, size=self.genome[c].paternalHaplotypeLength, allele='p')
+                self.writable(c).tandemDuplicate(start=0, size=self.genome[c].paternalHaplotypeLength, allele='p')
+            self.alleles().update(c, 'm', self.genome[c].maternalHaplotypeLength)
+            self.alleles().update(c, 'p', self.genome[c].paternalHaplotypeLength)
         self.mutationLabels.append("WGD")
+        self.events.append(('wgd', None, None, 0, 0))
 
     def wcl(self, chromosome, allele):
         size = self.genome[chromosome].maternalHaplotypeLength if allele == 'm' else self.genome[chromosome].paternalHaplotypeLength
-        self.genome[chromosome].delete(start=0, size=size, allele=allele)
+        self.writable(chromosome).delete(start=0, size=size, allele=allele)
+        self.alleles().update(chromosome, allele, 0)
         self.mutationLabels.append("{}-{} loss".format(allele.upper(), chromosome))
+        self.events.append(('wcl', chromosome, allele, 0, size))
 
     def tandemDuplicate(self, chromosome, start, size, allele, arm=False):
-        self.genome[chromosome].tandemDuplicate(start=start, size=size, allele=allele)
+        self.writable(chromosome).tandemDuplicate(start=start, size=size, allele=allele)
+        self.alleles().update(chromosome, allele, self.genome[chromosome].maternalHaplotypeLength if allele == 'm' else self.genome[chromosome].paternalHaplotypeLength)
         if not arm:
             self.mutationLabels.append("({},{}) tdup in {}-{}".format(start, start+size, allele.upper(), chromosome))
         else:
             self.mutationLabels.append("({},{}) dup of {}-{} arm".format(start, start+size, allele.upper(), chromosome))
+        self.events.append(('armdup' if arm else 'dup', chromosome, allele, start, size))
 
     def delete(self, chromosome, start, size, allele, arm=False):
-        self.genome[chromosome].delete(start=start, size=size, allele=allele)
+        self.writable(chromosome).delete(start=start, size=size, allele=allele)
+        self.alleles().update(chromosome, allele, self.genome[chromosome].maternalHaplotypeLength if allele == 'm' else self.genome[chromosome].paternalHaplotypeLength)
         if not arm:
             self.mutationLabels.append("({},{}) del in {}-{}".format(start, start+size, allele.upper(), chromosome))
         else:
             self.mutationLabels.append("({},{}) del of {}-{} arm".format(start, start+size, allele.upper(), chromosome))
-
-    def buildGenome(self, maternaloutput, paternaloutput):
-
-        def buildChromosome(sequence, haplotype, reference):
-            referencesequence = {bi : sequence[bi[0]:bi[1]] for bi in reference}
-            result = ''
-            for bi in haplotype:
-                result += ''.join(referencesequence[bi])
-            return result
-
-        with open(self.humanGenome.maternalfa, 'r') as mafa:
-            with open(maternaloutput, 'w') as maout:
-                name = ''
-                sequence = []
-                for line in mafa:
-                    if line != '':
-                        if line[0] == '>':
-                            if name != '' and name in self.chromosomes and self.genome[name].maternalHaplotypeLength > 0:
-                                maout.write(">{}\n".format(name))
-                                assert(len(sequence) == self.genome[name].length)
-                                maout.write("{}\n".format(buildChromosome(sequence, self.genome[name].maternalHaplotype, self.genome[name].reference)))
-                            name = line.strip()[1:]
-                            sequence = []
-                        else:
-                            if name in self.chromosomes and self.genome[name].maternalHaplotypeLength > 0:
-                                sequence += list(line.strip())
-                if len(sequence) > 0:
-                    if name != '' and name in self.chromosomes:
-                        maout.write(">{}\n".format(name))
-                        assert(len(sequence) == self.genome[name].length)
-                        maout.write("{}\n".format(buildChromosome(sequence, self.genome[name].maternalHaplotype, self.genome[name].reference)))
-
-        with open(self.humanGenome.paternalfa, 'r') as pafa:
-            with open(paternaloutput, 'w') as paout:
-                name = ''
-                sequence = []
-                for line in pafa:
-                    if line != '':
-                        if line[0] == '>':
-                            if name != '' and name in self.chromosomes and self.genome[name].paternalHaplotypeLength > 0:
-                                paout.write(">{}\n".format(name))
-                                assert(len(sequence) == self.genome[name].length)
-                                paout.write("{}\n".format(buildChromosome(sequence, self.genome[name].paternalHaplotype, self.genome[name].reference)))
-                            name = line.strip()[1:]
-                            sequence = []
-                        else:
-                            if name in self.chromosomes:
-                                sequence += list(line.strip())
-                if len(sequence) > 0:
-                    if name != '' and name in self.chromosomes and self.genome[name].paternalHaplotypeLength > 0:
-                        paout.write(">{}\n".format(name))
-                        assert(len(sequence) == self.genome[name].length)
-                        paout.write("{}\n".format(buildChromosome(sequence, self.genome[name].paternalHaplotype, self.genome[name].reference)))
-
+        self.events.append(('armdel' if arm else 'del', chromosome, allele, start, size))
+
+    def replay(self, events):
+        # Events are applied in the logged order, which rebuilds the same genome, labels and log
+        for kind, chromosome, allele, start, size in events:
+            if kind == 'wgd':
+                self.wgd()
+            elif kind == 'wcl':
+                self.wcl(chromosome=chromosome, allele=allele)
+            elif kind == 'dup' or kind == 'armdup':
+                self.tandemDuplicate(chromosome=chromosome, start=start, size=size, allele=allele, arm=(kind == 'armdup'))
+            elif kind == 'del' or kind == 'armdel':
+                self.delete(chromosome=chromosome, start=start, size=size, allele=allele, arm=(kind == 'armdel'))
+            else:
+                raise ValueError(Support.error('Unknown mutation event {} in clone {}!'.format(kind, self.label)))
 
 
 class Chromosome:
@@ -215,27 +358,147 @@ class Chromosome:
         self.name = name
         self.length = length
         self.binsize = binsize
-        self.reference = Support.bins(size=self.length, step=self.binsize)
-        self.maternalHaplotype = copy.deepcopy(self.reference)
-        self.maternalHaplotypeLength = copy.deepcopy(self.length)
-        self.paternalHaplotype = copy.deepcopy(self.reference)
-        self.paternalHaplotypeLength = copy.deepcopy(self.length)
+        # Haplotypes are arrays of indices of the reference bins, which all have the same size but the last one, such
+        # that the positions of the last bin in every haplotype are enough to index the cumulative lengths
+        self.numbins = (self.length - 1) // self.binsize + 1
+        self.lastsize = self.length - (self.numbins - 1) * self.binsize
+        self.reference = array('i', xrange(self.numbins))
+        self.maternalHaplotype = array('i', self.reference)
+        self.maternalHaplotypeLength = self.length
+        self.maternalLastBins = array('l', [self.numbins - 1])
+        self.paternalHaplotype = array('i', self.reference)
+        self.paternalHaplotypeLength = self.length
+        self.paternalLastBins = array('l', [self.numbins - 1])
+
+    def copy(self):
+        # The reference is shared since it is never modified
+        other = copy.copy(self)
+        other.maternalHaplotype = array('i', self.maternalHaplotype)
+        other.maternalLastBins = array('l', self.maternalLastBins)
+        other.paternalHaplotype = array('i', self.paternalHaplotype)
+        other.paternalLastBins = array('l', self.paternalLastBins)
+        return other
+
+    def bin(self, index):
+        return index * self.binsize, min((index + 1) * self.binsize, self.length)
+
+    def offset(self, lastbins, k):
+        # Length of the first k bins of a haplotype
+        return k * self.binsize - (self.binsize - self.lastsize) * bisect_left(lastbins, k)
+
+    def runs(self, haplotype):
+        # Maximal intervals of the reference which are consecutive in the haplotype
+        for first, last in Support.runs(haplotype):
+            yield first * self.binsize, min(last * self.binsize, self.length)
+
+    def tandemDuplicate(self, start, size, allele):
+        if allele.lower() == "m":
+            if start > self.maternalHaplotypeLength:
+                raise ValueError("The starting point of a mutation cannot be over maternal-haplotype-chromosome length!")
+            else:
+                offset = (lambda k : self.offset(self.maternalLastBins, k))
+                startbin, endbin = Support.startendbins(offset=offset, numbins=len(self.maternalHaplotype), start=start, size=size)
+                self.maternalHaplotypeLength += offset(endbin) - offset(startbin)
+                self.maternalHaplotype[endbin:endbin] = self.maternalHaplotype[startbin:endbin]
+                self.maternalLastBins = duplicateBins(self.maternalLastBins, startbin, endbin)
+        elif allele.lower() == "p":
+            if start > self.paternalHaplotypeLength:
+                raise ValueError("The starting point of a mutation cannot be over paternal-haplotype-chromosome length!")
+            else:
+                offset = (lambda k : self.offset(self.paternalLastBins, k))
+                startbin, endbin = Support.startendbins(offset=offset, numbins=len(self.paternalHaplotype), start=start, size=size)
+                self.paternalHaplotypeLength += offset(endbin) - offset(startbin)
+                self.paternalHaplotype[endbin:endbin] = self.paternalHaplotype[startbin:endbin]
+                self.paternalLastBins = duplicateBins(self.paternalLastBins, startbin, endbin)
+        else:
+            raise ValueError("The specified allele should be equal to either M or P (non-case sensitive)!")
+
+    def delete(self, start, size, allele):
+        if allele.lower() == "m":
+            if start > self.maternalHaplotypeLength:
+                raise ValueError("The starting point of a mutation cannot be over maternal-haplotype-chromosome length!")
+            else:
+                offset = (lambda k : self.offset(self.maternalLastBins, k))
+                startbin, endbin = Support.startendbins(offset=offset, numbins=len(self.maternalHaplotype), start=start, size=size)
+                self.maternalHaplotypeLength -= offset(endbin) - offset(startbin)
+                del self.maternalHaplotype[startbin:endbin]
+                self.maternalLastBins = deleteBins(self.maternalLastBins, startbin, endbin)
+        elif allele.lower() == "p":
+            if start > self.paternalHaplotypeLength:
+                raise ValueError("The starting point of a mutation cannot be over paternal-haplotype-chromosome length!")
+            else:
+                offset = (lambda k : self.offset(self.paternalLastBins, k))
+                startbin, endbin = Support.startendbins(offset=offset, numbins=len(self.paternalHaplotype), start=start, size=size)
+                self.paternalHaplotypeLength -= offset(endbin) - offset(startbin)
+                del self.paternalHaplotype[startbin:endbin]
+                self.paternalLastBins = deleteBins(self.paternalLastBins, startbin, endbin)
+        else:
+            raise ValueError("The specified allele should be equal to either M or P (non-case sensitive)!")
+
+
+def duplicateBins(positions, startbin, endbin):
+    # Update the sorted positions of the bins after duplicating [startbin, endbin) in tandem
+    first, last = bisect_left(positions, startbin), bisect_left(positions, endbin)
+    shift = endbin - startbin
+    return positions[:last] + array('l', (pos + shift for pos in positions[first:]))
+
+
+def deleteBins(positions, startbin, endbin):
+    # Update the sorted positions of the bins after deleting [startbin, endbin)
+    first, last = bisect_left(positions, startbin), bisect_left(positions, endbin)
+    shift = endbin - startbin
+    return positions[:first] + array('l', (pos - shift for pos in positions[last:]))
+
+
+class IntervalChromosome:
+
+    def __init__(self, name, length):
+        self.name = name
+        self.length = length
+        # Haplotypes are lists of intervals of the reference, which are split only at the breakpoints of mutations
+        self.reference = [(0, self.length)]
+        self.maternalHaplotype = [(0, self.length)]
+        self.maternalHaplotypeLength = self.length
+        self.paternalHaplotype = [(0, self.length)]
+        self.paternalHaplotypeLength = self.length
+
+    def copy(self):
+        other = copy.copy(self)
+        other.maternalHaplotype = list(self.maternalHaplotype)
+        other.paternalHaplotype = list(self.paternalHaplotype)
+        return other
+
+    def runs(self, haplotype):
+        # Maximal intervals of the reference which are consecutive in the haplotype
+        start = None
+        for s, e in haplotype:
+            if start == None:
+                start, end = s, e
+            elif s == end:
+                end = e
+            else:
+                yield start, end
+                start, end = s, e
+        if start != None:
+            yield start, end
 
     def tandemDuplicate(self, start, size, allele):
         if allele.lower() == "m":
             if start > self.maternalHaplotypeLength:
                 raise ValueError("The starting point of a mutation cannot be over maternal-haplotype-chromosome length!")
             else:
-                startbin, endbin = Support.startendbins(bins=self.maternalHaplotype, start=start, size=size)
-                self.maternalHaplotype = self.maternalHaplotype[0:startbin] + self.maternalHaplotype[startbin:endbin] + self.maternalHaplotype[startbin:endbin] + self.maternalHaplotype[endbin:]
-                self.maternalHaplotypeLength = sum(seg[1] - seg[0] for seg in self.maternalHaplotype)
+                end = min(start + size, self.maternalHaplotypeLength)
+                first, last = split(self.maternalHaplotype, start), split(self.maternalHaplotype, end)
+                self.maternalHaplotype[last:last] = self.maternalHaplotype[first:last]
+                self.maternalHaplotypeLength += end - start
         elif allele.lower() == "p":
             if start > self.paternalHaplotypeLength:
                 raise ValueError("The starting point of a mutation cannot be over paternal-haplotype-chromosome length!")
             else:
-                startbin, endbin = Support.startendbins(bins=self.paternalHaplotype, start=start, size=size)
-                self.paternalHaplotype = self.paternalHaplotype[0:startbin] + self.paternalHaplotype[startbin:endbin] + self.paternalHaplotype[startbin:endbin] + self.paternalHaplotype[endbin:]
-                self.paternalHaplotypeLength = sum(seg[1] - seg[0] for seg in self.paternalHaplotype)
+                end = min(start + size, self.paternalHaplotypeLength)
+                first, last = split(self.paternalHaplotype, start), split(self.paternalHaplotype, end)
+                self.paternalHaplotype[last:last] = self.paternalHaplotype[first:last]
+                self.paternalHaplotypeLength += end - start
         else:
             raise ValueError("The specified allele should be equal to either M or P (non-case sensitive)!")
 
@@ -244,15 +507,30 @@ class Chromosome:
             if start > self.maternalHaplotypeLength:
                 raise ValueError("The starting point of a mutation cannot be over maternal-haplotype-chromosome length!")
             else:
-                startbin, endbin = Support.startendbins(bins=self.maternalHaplotype, start=start, size=size)
-                self.maternalHaplotype = self.maternalHaplotype[0:startbin] + self.maternalHaplotype[endbin:]
-                self.maternalHaplotypeLength = sum(seg[1] - seg[0] for seg in self.maternalHaplotype)
+                end = min(start + size, self.maternalHaplotypeLength)
+                first, last = split(self.maternalHaplotype, start), split(self.maternalHaplotype, end)
+                del self.maternalHaplotype[first:last]
+                self.maternalHaplotypeLength -= end - start
         elif allele.lower() == "p":
             if start > self.paternalHaplotypeLength:
                 raise ValueError("The starting point of a mutation cannot be over paternal-haplotype-chromosome length!")
             else:
-                startbin, endbin = Support.startendbins(bins=self.paternalHaplotype, start=start, size=size)
-                self.paternalHaplotype = self.paternalHaplotype[0:startbin] + self.paternalHaplotype[endbin:]
-                self.paternalHaplotypeLength = sum(seg[1] - seg[0] for seg in self.paternalHaplotype)
+                end = min(start + size, self.paternalHaplotypeLength)
+                first, last = split(self.paternalHaplotype, start), split(self.paternalHaplotype, end)
+                del self.paternalHaplotype[first:last]
+                self.paternalHaplotypeLength -= end - start
         else:
             raise ValueError("The specified allele should be equal to either M or P (non-case sensitive)!")
+
+
+def split(haplotype, position):
+    # Split the interval containing the given position of the haplotype and return the index of the interval starting
+    # there
+    offsets = [0] + list(Support.cumsum(e - s for s, e in haplotype))
+    i = bisect_right(offsets, position) - 1
+    if i == len(haplotype) or offsets[i] == position:
+        return i
+    s, e = haplotype[i]
+    cut = s + position - offsets[i]
+    haplotype[i:i + 1] = [(s, cut), (cut, e)]
+    return i + 1
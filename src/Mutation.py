@@ -1,18 +1,70 @@
 import random
+from multiprocessing import Pool
 
-import Genomics
 import Evolution
 import Support
 
 
-def simulateEvolution(numclones, humanGenome, binsize, mutations):
+def simulateEvolution(numclones, humanGenome, binsize, mutations, seed=None, jobs=1, topology='random'):
     # clonalwgd, clonalwcl, clonalcam, clonalfocal, subclonalwgd, subclonalwcl, subclonalcam, subclonalfocal = mutations
-    evolution = Evolution.RandomTree(n=numclones, humanGenome=humanGenome, binsize=binsize)
+    evolution = Evolution.RandomTree(n=numclones, humanGenome=humanGenome, binsize=binsize, topology=topology)
     sublocations = locateSubclonal(clones=evolution.clones, mutations=mutations)
-    mutate(clone=evolution.root, mutations=mutations, sublocations=sublocations)
+    if seed == None:
+        seed = random.getrandbits(64)
+
+    # Every clone draws its mutations from its own random stream, such that results do not depend on the order in which
+    # clones are mutated nor on the number of jobs
+    if jobs == 1:
+        mutateSubtree(clone=evolution.root, mutations=mutations, sublocations=sublocations, seed=seed)
+    else:
+        # Clones closest to the root are mutated first until there are enough subtrees to mutate in parallel, which
+        # share the genomes of their ancestors read-only through the forked processes
+        pending = [evolution.root]
+        while 0 < len(pending) < jobs:
+            clone = pending.pop(0)
+            mutate(clone=clone, mutations=mutations, sublocations=sublocations, seed=seed)
+            pending.extend(clone.children)
+        if len(pending) > 0:
+            pool = Pool(processes=min(jobs, len(pending)), initializer=setupSubtree, initargs=(evolution, mutations, sublocations, seed))
+            results = pool.map(simulateSubtree, [clone.idx for clone in pending], chunksize=1)
+            pool.close()
+            pool.join()
+            for result in results:
+                for idx, labels, events, changed in result:
+                    clone = evolution.mapclone[idx]
+                    clone.genome = dict(clone.parent.genome)
+                    clone.genome.update(changed)
+                    clone.owned = set()
+                    clone.actives = None
+                    clone.mutationLabels = labels
+                    clone.events = events
     return evolution
 
 
+def mutateSubtree(clone, mutations, sublocations, seed):
+    # Clones are mutated in pre-order such that every clone inherits from its parent after this has been mutated
+    order = []
+    stack = [clone]
+    while len(stack) > 0:
+        clone = stack.pop()
+        mutate(clone=clone, mutations=mutations, sublocations=sublocations, seed=seed)
+        order.append(clone)
+        stack.extend(reversed(clone.children))
+    return order
+
+
+def setupSubtree(evolution, mutations, sublocations, seed):
+    global subtree
+    subtree = (evolution, mutations, sublocations, seed)
+
+
+def simulateSubtree(idx):
+    # Only the chromosomes that every clone changed with respect to its parent are sent back
+    evolution, mutations, sublocations, seed = subtree
+    order = mutateSubtree(clone=evolution.mapclone[idx], mutations=mutations, sublocations=sublocations, seed=seed)
+    return [(clone.idx, clone.mutationLabels, clone.events, {c : clone.genome[c] for c in clone.genome if not clone.genome[c] is clone.parent.genome[c]}) for clone in order]
+
+
 def locateSubclonal(clones, mutations):
     cidx = [clone.idx for clone in clones if clone.parent != None]
     sublocations = {}
@@ -23,55 +75,51 @@ def locateSubclonal(clones, mutations):
     return sublocations
 
 
-def mutate(clone, mutations, sublocations):
+def mutate(clone, mutations, sublocations, seed):
+    rng = Support.rngstream(seed, '{}:mutations'.format(clone.label))
     if clone.parent == None:
-        mutateClonal(clone=clone, wgd=mutations["clonalwgd"], wcl=mutations["clonalwcl"], cam=mutations["clonalcam"], focal=mutations["clonalfocal"], ratioAD=mutations["ratioAD"])
+        mutateClonal(clone=clone, wgd=mutations["clonalwgd"], wcl=mutations["clonalwcl"], cam=mutations["clonalcam"], focal=mutations["clonalfocal"], ratioAD=mutations["ratioAD"], rng=rng)
     else:
         clone.inherit(clone.parent)
-        mutateSubclonal(clone=clone, sublocations=sublocations, focal=mutations["subclonalfocal"], ratioAD=mutations["ratioAD"])
-    for child in clone.children:
-        assert(child.parent is clone)
-        # child.inherit(clone)
-        mutate(clone=child, mutations=mutations, sublocations=sublocations)
+        mutateSubclonal(clone=clone, sublocations=sublocations, focal=mutations["subclonalfocal"], ratioAD=mutations["ratioAD"], rng=rng)
 
 
-def mutateClonal(clone, wgd, wcl, cam, focal, ratioAD):
+def mutateClonal(clone, wgd, wcl, cam, focal, ratioAD, rng=random):
     timing = [(0,) for i in xrange(wgd)] + [(1,) for i in xrange(wcl)] + [(2,) for i in xrange(cam)]
     for size in focal:
         timing += [(3, size[0], size[1]) for i in xrange(focal[size])]
-    random.shuffle(timing)
+    rng.shuffle(timing)
     for event in timing:
-        mutation(clone=clone, event=event, ratioAD=ratioAD)
+        mutation(clone=clone, event=event, ratioAD=ratioAD, rng=rng)
 
 
-def mutateSubclonal(clone, sublocations, focal, ratioAD):
+def mutateSubclonal(clone, sublocations, focal, ratioAD, rng=random):
     timing = [(0,) for i in sublocations["subclonalwgd"] if clone.idx == i]
     timing += [(1,) for i in sublocations["subclonalwcl"] if clone.idx == i]
     timing += [(2,) for i in sublocations["subclonalcam"] if clone.idx == i]
     for size in focal:
         timing += [(3, size[0], size[1]) for i in range(focal[size])]
-    random.shuffle(timing)
+    rng.shuffle(timing)
     for event in timing:
-        mutation(clone=clone, event=event, ratioAD=ratioAD)
+        mutation(clone=clone, event=event, ratioAD=ratioAD, rng=rng)
 
 
-def mutation(clone, event, ratioAD):
+def mutation(clone, event, ratioAD, rng=random):
     if event[0] == 0:
         ### Whole-genome duplication (WGD)
         clone.wgd()
     else:
-        actives = [(clone.genome[c].name, 'm', clone.genome[c].maternalHaplotypeLength) for c in clone.genome if clone.genome[c].maternalHaplotypeLength > 0]
-        actives += [(clone.genome[c].name, 'p', clone.genome[c].paternalHaplotypeLength) for c in clone.genome if clone.genome[c].paternalHaplotypeLength > 0]
+        actives = clone.alleles()
         if len(actives) > 0:
             if event[0] == 1:
                 ### Whole-chromosome loss (WCL)
-                target = random.choice([(e[0], e[1]) for e in actives])
+                target = actives.choice(rng)
                 clone.wcl(chromosome=target[0], allele=target[1])
             elif event[0] == 2:
                 ### Chromosome-arm mutation (CAM)
-                target = random.choice([(e[0], e[1]) for e in actives])
+                target = actives.choice(rng)
                 breakpoint = int(clone.genome[target[0]].maternalHaplotypeLength / 2.0) if target[1] == 'm' else int(clone.genome[target[0]].paternalHaplotypeLength / 2.0)
-                if random.random() < 0.5:
+                if rng.random() < 0.5:
                     # Left arm
                     start = 0
                     size = breakpoint
@@ -80,7 +128,7 @@ def mutation(clone, event, ratioAD):
                     size = clone.genome[target[0]].maternalHaplotypeLength if target[1] == 'm' else clone.genome[target[0]].paternalHaplotypeLength
                     size = max(breakpoint, size-breakpoint)
                     start = breakpoint
-                if random.random() < ratioAD:
+                if rng.random() < ratioAD:
                     # Arm duplication
                     clone.tandemDuplicate(chromosome=target[0], start=start, size=size, allele=target[1], arm=True)
                 else:
@@ -88,12 +136,12 @@ def mutation(clone, event, ratioAD):
                     clone.delete(chromosome=target[0], start=start, size=size, allele=target[1], arm=True)
             elif event[0] == 3:
                 ### Focal copy-number aberration
-                target = Support.wchoice([(e[0], e[1]) for e in actives], [e[2] for e in actives])
-                size = max(int(round(random.gauss(event[1], event[2]))), 0)
+                target = actives.wchoice(rng)
+                size = max(int(round(rng.gauss(event[1], event[2]))), 0)
                 size = min(size, clone.genome[target[0]].maternalHaplotypeLength if target[1] == 'm' else clone.genome[target[0]].paternalHaplotypeLength)
-                breakpoint = random.randint(0, max((clone.genome[target[0]].maternalHaplotypeLength-1-size if target[1] == 'm' else clone.genome[target[0]].paternalHaplotypeLength-1-size), 0))
+                breakpoint = rng.randint(0, max((clone.genome[target[0]].maternalHaplotypeLength-1-size if target[1] == 'm' else clone.genome[target[0]].paternalHaplotypeLength-1-size), 0))
                 assert(breakpoint < clone.genome[target[0]].maternalHaplotypeLength if target[1] == 'm' else clone.genome[target[0]].paternalHaplotypeLength)
-                if random.random() < ratioAD:
+                if rng.random() < ratioAD:
                     # Focal duplication
                     clone.tandemDuplicate(chromosome=target[0], start=breakpoint, size=size, allele=target[1])
                 else:
@@ -1,75 +1,204 @@
+import os
 import sys
-import math
 import random
+import hashlib
 import datetime
+from array import array
 
 import Support as sp
 
-def bins(size, step):
-    return zip(xrange(0, size-step, step), xrange(step, size, step)) + [(int(math.floor((size - 1) / step)) * step, size)]
-
 def cumsum(lis):
     total = 0
     for x in lis:
         total += x
         yield total
 
-def cumsumbins(lis):
-    total = 0
-    for x in lis:
-        total += x[1] - x[0]
-        yield total
-
-def startendbins(bins, start, size):
-    cumsum = list(cumsumbins(bins))
-    startbin = -1
+def runs(bins):
+    # Merge consecutive bin indices into maximal ranges [first, last)
+    first = None
+    for b in bins:
+        if first == None:
+            first, last = b, b + 1
+        elif b == last:
+            last += 1
+        else:
+            yield first, last
+            first, last = b, b + 1
+    if first != None:
+        yield first, last
 
-    for index, item in enumerate(cumsum):
-        if item > start:
-            startbin = index
-            break
+def startendbins(offset, numbins, start, size):
+    # Bins are found by bisection over the cumulative length offset(k) of the first k bins
+    startbin = firstbin(offset, numbins, start)
 
-    if startbin == -1:
+    if startbin == numbins:
         raise ValueError('The start bin must be inside the given sequence of bins!')
 
-    endbin = -1
-    for index, item in enumerate(cumsum[startbin:]):
-        if item > start+size:
-            endbin = index
-            break
+    return startbin, min(firstbin(offset, numbins, start+size) + 1, numbins)
+
+def firstbin(offset, numbins, position):
+    # Index of the first bin ending after the given position
+    lo, hi = 0, numbins
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if offset(mid + 1) <= position:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def rngstream(seed, key):
+    # Independent and reproducible random stream for every key derived from the global seed
+    return random.Random(int(hashlib.md5('{}:{}'.format(seed, key)).hexdigest(), 16))
+
+class FenwickTree:
+
+    def __init__(self, values):
+        # Binary indexed tree over the given non-negative values supporting updates and prefix sums in O(log n)
+        self.values = list(values)
+        self.tree = [0] * (len(self.values) + 1)
+        for i, value in enumerate(self.values):
+            self.tree[i + 1] += value
+            parent = i + 1 + ((i + 1) & -(i + 1))
+            if parent <= len(self.values):
+                self.tree[parent] += self.tree[i + 1]
+        self.total = sum(self.values)
+
+    def __len__(self):
+        return len(self.values)
 
-    return startbin, startbin+endbin+1 if endbin != -1 else len(bins)
+    def copy(self):
+        other = FenwickTree([])
+        other.values = list(self.values)
+        other.tree = list(self.tree)
+        other.total = self.total
+        return other
 
-def wchoice(elements, weights):
-    assert(len(elements) == len(weights))
-    total = int(sum(weights))
-    pick = random.randint(1, total)
-    upto = 1
-    for el, w in zip(elements, weights):
-        if upto + w >= pick:
-            return el
-        upto += w
-    assert(False)
+    def update(self, i, value):
+        delta = value - self.values[i]
+        self.values[i] = value
+        self.total += delta
+        i += 1
+        while i <= len(self.values):
+            self.tree[i] += delta
+            i += i & -i
+
+    def search(self, target):
+        # Smallest index whose inclusive prefix sum is at least the target
+        pos = 0
+        step = 1 << (len(self.values).bit_length() - 1) if len(self.values) > 0 else 0
+        while step > 0:
+            if pos + step <= len(self.values) and self.tree[pos + step] < target:
+                pos += step
+                target -= self.tree[pos]
+            step >>= 1
+        return pos
 
 
 def parseSNPList(filename):
     if filename != None:
-        snplist = {}
-        with open(filename, 'r') as f:
-            for line in f:
-                line = line.strip().split()
-                if len(line) > 2 and len(line[2]) == 1 and len(line[3]) == 1:
-                    pos = int(line[1])
-                    if not line[0] in snplist:
-                        snplist[line[0]] = {}
-                    if not pos in snplist[line[0]]:
-                        snplist[line[0]][pos] = (line[2].upper(), line[3].upper())
-                        assert snplist[line[0]][pos][0] in {'A', 'C', 'G', 'T'} and snplist[line[0]][pos][1] in {'A', 'C', 'G', 'T'}
-        return snplist
+        return SNPList(filename)
     else:
         return None
 
 
+class SNPList:
+
+    # Every SNP is stored as a sorted position and one byte encoding the two alleles with 2 bits each
+    BASES = 'ACGT'
+    FIRST = ''.join([BASES[code >> 2] if code < 16 else 'N' for code in xrange(256)])
+    SECOND = ''.join([BASES[code & 3] if code < 16 else 'N' for code in xrange(256)])
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.cache = filename + '.cache'
+        self.counts = {}
+        self.columns = None
+        stat = os.stat(filename)
+        self.key = '{}\t{}\t{}\t{}'.format(SNPList.VERSION, stat.st_size, int(stat.st_mtime), self.fingerprint(stat.st_size))
+        if not self.loadManifest():
+            columns = self.parse()
+            try:
+                self.store(columns)
+            except (IOError, OSError):
+                log(msg='The cache of the SNP list cannot be written in {}, the SNP list is kept in memory\n'.format(self.cache), level='WARN')
+                self.columns = columns
+
+    def __contains__(self, chromosome):
+        return chromosome in self.counts
+
+    def __getitem__(self, chromosome):
+        if self.columns != None:
+            return self.columns[chromosome]
+        positions = array('i')
+        alleles = bytearray()
+        with open(os.path.join(self.cache, '{}.pos'.format(chromosome)), 'rb') as f:
+            positions.fromfile(f, self.counts[chromosome])
+        with open(os.path.join(self.cache, '{}.alleles'.format(chromosome)), 'rb') as f:
+            alleles += f.read()
+        assert(len(alleles) == len(positions))
+        return positions, alleles
+
+    def fingerprint(self, size, span=1 << 16):
+        # Digest of the head and tail of the file such that edits keeping its size and time in seconds are detected
+        digest = hashlib.md5()
+        with open(self.filename, 'rb') as f:
+            digest.update(f.read(span))
+            if size > span:
+                f.seek(max(span, size - span))
+                digest.update(f.read(span))
+        return digest.hexdigest()
+
+    def loadManifest(self):
+        manifest = os.path.join(self.cache, 'manifest.tsv')
+        if not os.path.isfile(manifest):
+            return False
+        with open(manifest, 'r') as f:
+            if f.readline().rstrip('\n') != self.key:
+                return False
+            for line in f:
+                chro, count = line.strip().split('\t')
+                self.counts[chro] = int(count)
+        return True
+
+    def parse(self):
+        codes = {b : i for i, b in enumerate(SNPList.BASES)}
+        columns = {}
+        with open(self.filename, 'r') as f:
+            for line in f:
+                line = line.strip().split()
+                if len(line) > 3 and len(line[2]) == 1 and len(line[3]) == 1 and line[0][0] != '#':
+                    ref = line[2].upper()
+                    alt = line[3].upper()
+                    assert ref in codes and alt in codes
+                    if not line[0] in columns:
+                        columns[line[0]] = (array('i'), bytearray())
+                    columns[line[0]][0].append(int(line[1]))
+                    columns[line[0]][1].append((codes[ref] << 2) | codes[alt])
+        for chro in columns:
+            positions, alleles = columns[chro]
+            order = sorted(xrange(len(positions)), key=positions.__getitem__)
+            # Only the first record is considered for repeated positions
+            order = [o for i, o in enumerate(order) if i == 0 or positions[o] != positions[order[i - 1]]]
+            columns[chro] = (array('i', (positions[o] for o in order)), bytearray(alleles[o] for o in order))
+            self.counts[chro] = len(order)
+        return columns
+
+    def store(self, columns):
+        if not os.path.isdir(self.cache):
+            os.makedirs(self.cache)
+        for chro in columns:
+            with open(os.path.join(self.cache, '{}.pos'.format(chro)), 'wb') as f:
+                columns[chro][0].tofile(f)
+            with open(os.path.join(self.cache, '{}.alleles'.format(chro)), 'wb') as f:
+                f.write(columns[chro][1])
+        # The manifest is written last such that an interrupted conversion is never considered valid
+        with open(os.path.join(self.cache, 'manifest.tsv'), 'w') as f:
+            f.write('{}\n'.format(self.key))
+            f.writelines('{}\t{}\n'.format(chro, self.counts[chro]) for chro in sorted(self.counts))
+
+
 def log(msg, level=None, lock=None):
     timestamp = '{:%Y-%b-%d %H:%M:%S}'.format(datetime.datetime.now())
     if level == "STEP":
@@ -132,8 +261,25 @@ def basesize(isize):
             size = int(isize[:-2]) * 1000
         elif isize[-2:] == "Mb":
             size = int(isize[:-2]) * 1000000
+        elif isize[-2:] == "Gb":
+            size = int(isize[:-2]) * 1000000000
         else:
             size = int(isize)
         return size
     except:
-        raise ValueError(sp.error("Size must be a number, optionally ending with either \"kb\" or \"Mb\"!"))
+        raise ValueError(sp.error("Size must be a number, optionally ending with either \"kb\", \"Mb\", or \"Gb\"!"))
+
+
+def parseRegion(region):
+    try:
+        if ':' in region:
+            name, interval = region.rsplit(':', 1)
+            start, end = interval.split('-')
+            start, end = basesize(start.replace(',', '')), basesize(end.replace(',', ''))
+            if start < 1 or end < start:
+                raise ValueError()
+            return (name, start - 1, end)
+        else:
+            return (region, None, None)
+    except ValueError:
+        raise ValueError(sp.error("Regions must be given as \"CHR\" or \"CHR:START-END\" with 1 <= START <= END!"))
@@ -8,6 +8,9 @@ import shlex
 import subprocess
 from multiprocessing import Process, Queue, JoinableQueue, Lock, Value
 import random
+from itertools import izip, groupby
+from operator import itemgetter
+from collections import deque
 
 import Genomics
 import Evolution
@@ -15,6 +18,7 @@ import Mutation
 import Support
 import Argparser
 import Builder
+import Checkpoint
 
 
 def main():
@@ -23,70 +27,107 @@ def main():
     logArgs(args)
     if args['rndseed'] != None:
         random.seed(args['rndseed'])
+    human = simulateHuman(args)
+    if args['numclones'] > 0:
+        simulateTumor(human, args)
+    else:
+        Support.log(msg="# No tumor clones will be generated as input tumor clones is 0\n", level="INFO")
+    Support.log('KTHXBY!\n', level='STEP')
 
-    Support.log(msg="# Setting up for simulating human diploid genome\n", level="STEP")
-    human = Genomics.HumanGenome(reference=args['reference'], snplist=args['snplist'], snpratio=args['snpratio'], HEHOratio=args['HEHOratio'], ignorelist=args['ignore'])
-    maternalhuman = os.path.join(args['xdir'], 'human.maternal.fa')
-    paternalhuman = os.path.join(args['xdir'], 'human.paternal.fa')
-    Support.log(msg="# Simulating human diploid genome\n", level="STEP")
-    human.buildGenome(maternalout=maternalhuman, paternalout=paternalhuman)
+
+def simulateHuman(args):
+    # Every stage is checkpointed in the running directory such that a resumed run reloads the completed stages
+    humanckpt = os.path.join(args['xdir'], 'human.ckpt')
+    if args['resume'] and os.path.isfile(humanckpt):
+        Support.log(msg="# Reloading human diploid genome from checkpoint {}\n".format(humanckpt), level="STEP")
+        human = Checkpoint.loadHuman(humanckpt, args)
+    else:
+        Support.log(msg="# Setting up for simulating human diploid genome\n", level="STEP")
+        human = Genomics.HumanGenome(reference=args['reference'], snplist=args['snplist'], snpratio=args['snpratio'], HEHOratio=args['HEHOratio'], ignorelist=args['ignore'], regions=args['regions'])
+        ext = '.2bit' if args['twobit'] else ('.fa.gz' if args['compress'] else '.fa')
+        if args['suffixes'] != None:
+            maternalhuman = paternalhuman = os.path.join(args['xdir'], 'normal{}'.format(ext))
+            suffixes = args['suffixes']
+        else:
+            maternalhuman = os.path.join(args['xdir'], 'human.maternal{}'.format(ext))
+            paternalhuman = os.path.join(args['xdir'], 'human.paternal{}'.format(ext))
+            suffixes = ('', '')
+        Support.log(msg="# Simulating human diploid genome\n", level="STEP")
+        human.buildGenome(maternalout=maternalhuman, paternalout=paternalhuman, jobs=args['jobs'], seed=args['rndseed'], width=args['linewidth'], compress=args['compress'], suffixes=suffixes, twobit=args['twobit'])
+        Checkpoint.saveHuman(humanckpt, human, args)
     Support.log('Chromosomes: {}\n'.format(', '.join(human.chromosomes)), level='INFO')
     Support.log('Number of simulated SNPs: {}\n'.format(human.numsnps), level='INFO')
     Support.log('Number of heterozygous SNPs: {}\n'.format(human.hetsnps), level='INFO')
-    Support.log('Maternal chromosome of human genome written in {}\n'.format(maternalhuman), level='INFO')
-    Support.log('Maternal chromosome of human genome written in {}\n'.format(paternalhuman), level='INFO')
+    Support.log('Maternal chromosome of human genome written in {}\n'.format(human.maternalfa), level='INFO')
+    Support.log('Paternal chromosome of human genome written in {}\n'.format(human.paternalfa), level='INFO')
+    return human
 
-    if args['numclones'] > 0:
+
+def simulateTumor(human, args):
+    tumorckpt = os.path.join(args['xdir'], 'tumor.ckpt')
+    if args['resume'] and os.path.isfile(tumorckpt):
+        Support.log(msg="# Reloading tumor clones and their evolution from checkpoint {}\n".format(tumorckpt), level="STEP")
+        tumor, stages = Checkpoint.loadTumor(tumorckpt, human, args)
+    else:
         Support.log(msg="# Simulating tumor clones and their evolution through specified CNAs\n", level="STEP")
-        tumor = Mutation.simulateEvolution(numclones=args['numclones'], humanGenome=human, binsize=args['binsize'], mutations=args['mutations'])
-        Support.log('Simulated tumor clones: {}\n'.format(', '.join([clone.label for clone in tumor.clones])), level='INFO')
-        Support.log('Founder tumor clone: {}\n'.format(tumor.root.label), level='INFO')
-        with open(os.path.join(args['xdir'], 'tumor.dot'), 'w') as o: o.write("{}\n".format(tumor.draw()))
-        Support.log('The resulting tumor evolution of clones and related CNAs have been drawn in {} as dot format\n'.format(os.path.join(args['xdir'], 'tumor.dot')), level='INFO')
-        Support.log('Genome length of the various tumor clones:\n\t{}\n'.format('\n\t'.join(['{}: {}'.format(clone.label, clone.genomeLength()) for clone in tumor.clones])), level='INFO')
+        tumor = Mutation.simulateEvolution(numclones=args['numclones'], humanGenome=human, binsize=args['binsize'], mutations=args['mutations'], seed=args['rndseed'], jobs=args['jobs'], topology=args['topology'])
+        stages = []
+        Checkpoint.saveTumor(tumorckpt, tumor, args, stages=stages)
+    Support.log('Simulated tumor clones: {}\n'.format(', '.join([clone.label for clone in tumor.clones])), level='INFO')
+    Support.log('Founder tumor clone: {}\n'.format(tumor.root.label), level='INFO')
+    with open(os.path.join(args['xdir'], 'tumor.dot'), 'w') as o: o.write("{}\n".format(tumor.draw()))
+    Support.log('The resulting tumor evolution of clones and related CNAs have been drawn in {} as dot format\n'.format(os.path.join(args['xdir'], 'tumor.dot')), level='INFO')
+    Support.log('Genome length of the various tumor clones:\n\t{}\n'.format('\n\t'.join(['{}: {}'.format(clone.label, clone.genomeLength()) for clone in tumor.clones])), level='INFO')
+    segout = os.path.join(args['xdir'], 'copynumbers.csv')
+    if not 'segmentation' in stages:
         Support.log('Computing and segmenting the copy-number profiles jointly for all tumor clones\n', level='INFO')
-        segments = segmentation(evolution=tumor)
-        Support.log('Total number of resulting segments= {}\n'.format(sum(len(segments[chro]) for chro in tumor.human.chromosomes)), level='INFO')
-        segout = os.path.join(args['xdir'], 'copynumbers.csv')
-        with open(segout, 'w') as o:
-            o.write('\t'.join(['#CHR', 'START', 'END'] + [clone.label for clone in tumor.clones]) + '\n')
-            o.write('\n'.join(['\t'.join(map(str, [chro, seg[0], seg[1]]+['{}|{}'.format(segments[chro][seg][clone.idx]['m'], segments[chro][seg][clone.idx]['p']) for clone in tumor.clones])) for chro in tumor.human.chromosomes for seg in sorted(segments[chro], key=(lambda x : x[0]))]))
-            o.write('\n')
-        Support.log('The allele-specific copy number profiles for every tumor clone has been written in {}\n'.format(segout), level='INFO')
+        numsegments = segmentation(evolution=tumor, output=segout)
+        Support.log('Total number of resulting segments= {}\n'.format(numsegments), level='INFO')
+        stages.append('segmentation')
+        Checkpoint.saveTumor(tumorckpt, tumor, args, stages=stages)
+    Support.log('The allele-specific copy number profiles for every tumor clone has been written in {}\n'.format(segout), level='INFO')
+    builder = Builder.CloneGenomeBuilder(tumor, args['xdir'], width=args['linewidth'], compress=args['compress'], suffixes=args['suffixes'], twobit=args['twobit'])
+    if not 'genomes' in stages:
         Support.log('Writing the FASTA-format genomes of tumor clones\n', level='INFO')
-        if args['jobs'] == 1:
-            for clone in tumor.clones:
-                maternalout = os.path.join(args['xdir'], '{}.maternal.fa'.format(clone.label))
-                paternalout = os.path.join(args['xdir'], '{}.paternal.fa'.format(clone.label))
-                clone.buildGenome(maternalout, paternalout)
-        else:
-            builder = Builder.CloneGenomeBuilder(tumor, args['xdir'])
-            builder.parallelbuild(args['jobs'])
-        Support.log('Tumor-clone genomes wrote in:\n{}\n'.format('\n'.join(['\t{}: maternal > {} and paternal > {}'.format(clone.label, os.path.join(args['xdir'], '{}.maternal.fa'.format(clone.label)), os.path.join(args['xdir'], '{}.paternal.fa'.format(clone.label))) for clone in tumor.clones])), level='INFO')
-    else:
-        Support.log(msg="# No tumor clones will be generated as input tumor clones is 0\n", level="INFO")
-    Support.log('KTHXBY!\n', level='STEP')
+        builder.parallelbuild(args['jobs'], maxmemory=args['maxmemory'])
+        stages.append('genomes')
+        Checkpoint.saveTumor(tumorckpt, tumor, args, stages=stages)
+    Support.log('Tumor-clone genomes wrote in:\n{}\n'.format('\n'.join(['\t{}: maternal > {} and paternal > {}'.format(clone.label, builder.output(clone, 'maternal'), builder.output(clone, 'paternal')) for clone in tumor.clones])), level='INFO')
+    return tumor
 
 
-def segmentation(evolution):
-    profiles = {clone.idx : clone.copyNumberProfile() for clone in evolution.clones}
-    merge = {chro : {seg : {clone.idx : {'m' : profiles[clone.idx][chro]['m'][seg] if seg in profiles[clone.idx][chro]['m'] else 0, 'p' : profiles[clone.idx][chro]['p'][seg] if seg in profiles[clone.idx][chro]['p'] else 0} for clone in evolution.clones} for seg in evolution.root.genome[chro].reference} for chro in evolution.human.chromosomes}
-    segments = {chro : {} for chro in evolution.human.chromosomes}
-    for chro in evolution.human.chromosomes:
-        prev = sorted(evolution.root.genome[chro].reference, key=(lambda x : x[0]))[:-1]
-        succ = sorted(evolution.root.genome[chro].reference, key=(lambda x : x[0]))[1:]
-        start = prev[0][0]
-        for p, s in zip(prev, succ):
-            flag = True
+def segmentation(evolution, output):
+    # The copy numbers of every clone and allele are computed on the elementary segments delimited by the breakpoints of
+    # all clones through difference arrays, such that consecutive segments with the same copy numbers in all clones are
+    # merged in a single pass and streamed to the output
+    numsegments = 0
+    with open(output, 'w') as o:
+        o.write('\t'.join(['#CHR', 'START', 'END'] + [clone.label for clone in evolution.clones]) + '\n')
+        for chro in evolution.human.chromosomes:
+            # Chromosomes shared copy-on-write by several clones are only processed once
+            runs = {}
             for clone in evolution.clones:
-                if merge[chro][p][clone.idx]['m'] != merge[chro][s][clone.idx]['m'] or merge[chro][p][clone.idx]['p'] != merge[chro][s][clone.idx]['p']:
-                    flag = False
-                    break
-            if not flag:
-                segments[chro][(start, p[1])] = {clone.idx : {'m' : merge[chro][p][clone.idx]['m'], 'p' : merge[chro][p][clone.idx]['p']} for clone in evolution.clones}
-                start = s[0]
-        segments[chro][(start, succ[-1][1])] = {clone.idx : {'m' : merge[chro][succ[-1]][clone.idx]['m'], 'p' : merge[chro][succ[-1]][clone.idx]['p']} for clone in evolution.clones}
-    return segments
+                chromosome = clone.genome[chro]
+                for allele, haplotype in (('m', chromosome.maternalHaplotype), ('p', chromosome.paternalHaplotype)):
+                    if not (id(chromosome), allele) in runs:
+                        runs[id(chromosome), allele] = list(chromosome.runs(haplotype))
+            breakpoints = sorted(set(pos for key in runs for run in runs[key] for pos in run) | set([0, evolution.root.genome[chro].length]))
+            index = {pos : i for i, pos in enumerate(breakpoints)}
+            copies = {}
+            for key in runs:
+                diff = [0] * len(breakpoints)
+                for start, end in runs[key]:
+                    diff[index[start]] += 1
+                    diff[index[end]] -= 1
+                copies[key] = list(Support.cumsum(diff))
+            matrix = izip(*[copies[id(clone.genome[chro]), allele] for clone in evolution.clones for allele in ('m', 'p')])
+            for row, group in groupby(izip(breakpoints[:-1], breakpoints[1:], matrix), key=itemgetter(2)):
+                first = next(group)
+                last = deque(group, maxlen=1)
+                end = last[0][1] if len(last) > 0 else first[1]
+                o.write('\t'.join([chro, str(first[0]), str(end)] + ['{}|{}'.format(row[k], row[k + 1]) for k in xrange(0, len(row), 2)]) + '\n')
+                numsegments += 1
+    return numsegments
 
 
 def logArgs(args):
@@ -0,0 +1,102 @@
+#!/usr/bin/python2
+
+import os
+import random
+from itertools import product
+from multiprocessing import Pool, Process, Queue
+
+import Support
+import Argparser
+import mascotte
+
+
+def main():
+    Support.log(msg="# Parsing and checking the input arguments\n", level="STEP")
+    args = Argparser.parse_batch_arguments()
+    Support.log('\n'.join(["Arguments:"]+['\t{}:\t{}'.format(arg, args[arg]) for arg in args] + [""]), level="INFO")
+    if args['humanseed'] != None:
+        random.seed(args['humanseed'])
+
+    # The human genome is simulated once in the running directory and shared by all replicates
+    human = mascotte.simulateHuman(dict(args, rndseed=args['humanseed']))
+    seeds = args['rndseeds'] if args['rndseeds'] != None else [random.getrandbits(32) for i in xrange(args['replicates'])]
+
+    Support.log(msg="# Setting up the replicates for all combinations of parameters\n", level="STEP")
+    sweep = args['sweep']
+    names = ['numclones', 'clonalwgd', 'clonalwcl', 'clonalcam', 'clonalcna', 'subclonalwgd', 'subclonalwcl', 'subclonalcam', 'subclonalcna']
+    replicates = []
+    for values in product(*([sweep[name] for name in names] + [seeds])):
+        replicate = dict(zip(names + ['rndseed'], values))
+        replicate['xdir'] = os.path.join(args['xdir'], 'replicate{}'.format(len(replicates)))
+        replicates.append(replicate)
+    Support.log('Number of replicates: {}\n'.format(len(replicates)), level='INFO')
+
+    Support.log(msg="# Simulating tumor clones of all replicates\n", level="STEP")
+    # Replicates share the human genome through the forked processes, and the jobs are split across the replicates
+    # when these are fewer than the jobs
+    for k, replicate in enumerate(replicates):
+        replicate['jobs'] = max(1, args['jobs'] // len(replicates) + (1 if k < args['jobs'] % len(replicates) else 0))
+    if args['jobs'] == 1 or len(replicates) == 1:
+        setupReplicates(human, args)
+        results = map(simulateReplicate, replicates)
+    elif len(replicates) < args['jobs']:
+        # Every replicate is simulated by its own process, which is not a daemon such that it can start its own workers
+        setupReplicates(human, args)
+        queue = Queue()
+        processes = [Process(target=runReplicate, args=(k, replicate, queue)) for k, replicate in enumerate(replicates)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        for k, process in enumerate(processes):
+            if process.exitcode != 0:
+                raise ValueError(Support.error('The simulation of the replicate in {} has failed!'.format(replicates[k]['xdir'])))
+        results = [result for k, result in sorted(queue.get() for process in processes)]
+    else:
+        pool = Pool(processes=args['jobs'], initializer=setupReplicates, initargs=(human, args))
+        results = pool.map(simulateReplicate, replicates, chunksize=1)
+        pool.close()
+        pool.join()
+
+    manifest = os.path.join(args['xdir'], 'manifest.tsv')
+    with open(manifest, 'w') as o:
+        o.write('\t'.join(['#REPLICATE', 'DIRECTORY', 'SEED'] + [name.upper() for name in names] + ['SEGMENTS']) + '\n')
+        for k, (replicate, numsegments) in enumerate(zip(replicates, results)):
+            o.write('\t'.join(map(str, [k, replicate['xdir'], replicate['rndseed']] + [replicate[name] if replicate[name] != '' else 'None' for name in names] + [numsegments])) + '\n')
+    Support.log('The manifest of all replicates has been written in {}\n'.format(manifest), level='INFO')
+    Support.log('KTHXBY!\n', level='STEP')
+
+
+def setupReplicates(human, args):
+    global batch
+    batch = (human, args)
+
+
+def runReplicate(k, replicate, queue):
+    queue.put((k, simulateReplicate(replicate)))
+
+
+def simulateReplicate(replicate):
+    human, args = batch
+    if not os.path.isdir(replicate['xdir']):
+        os.mkdir(replicate['xdir'])
+    mutations = {'ratioAD' : args['adratio'],
+                 'clonalwgd' : replicate['clonalwgd'],
+                 'clonalwcl' : replicate['clonalwcl'],
+                 'clonalcam' : replicate['clonalcam'],
+                 'clonalfocal' : Argparser.parse_focal(replicate['clonalcna']),
+                 'subclonalwgd' : replicate['subclonalwgd'],
+                 'subclonalwcl' : replicate['subclonalwcl'],
+                 'subclonalcam' : replicate['subclonalcam'],
+                 'subclonalfocal' : Argparser.parse_focal(replicate['subclonalcna'])}
+    # Every replicate is simulated exactly as mascotte.py with the same random seed from the shared human genome
+    random.seed(replicate['rndseed'])
+    if replicate['numclones'] > 0:
+        mascotte.simulateTumor(human, dict(args, xdir=replicate['xdir'], numclones=replicate['numclones'], mutations=mutations, rndseed=replicate['rndseed'], jobs=replicate['jobs']))
+        with open(os.path.join(replicate['xdir'], 'copynumbers.csv')) as f:
+            return sum(1 for line in f) - 1
+    return 0
+
+
+if __name__ == '__main__':
+        main()